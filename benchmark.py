@@ -0,0 +1,211 @@
+#!/usr/bin/python
+# $Id$
+# vim:ft=python:sw=4:sta:et
+#
+# benchmark.py - Measure the overhead cronwatch adds to jobs
+# Copyright (C) 2011 David Lowry  < wdlowry at gmail dot com >
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+
+from __future__ import print_function
+
+import sys
+import os
+import time
+import json
+
+from optparse import OptionParser
+from tempfile import mkdtemp
+from shutil import rmtree
+
+###############################################################################
+# Global variables
+###############################################################################
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                        'bench_baseline.json')
+CRONWATCH = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                         'cronwatch.py')
+
+# Prints size megabytes of output in 100 byte lines
+PRINTER = '''
+import sys
+line = 'x' * 99 + '\\n'
+block = line * 10240
+for i in range(%i):
+    sys.stdout.write(block)
+'''
+
+# Prints a log with a mix of lines for the patterns to look at
+GENERATOR = '''
+import sys
+words = ['INFO', 'DEBUG', 'WARNING', 'ERROR', 'NOTICE']
+for i in range(%i):
+    sys.stdout.write('2011-01-01 00:00:%%02i %%s request %%i took %%ims\\n' %%
+                     (i %% 60, words[i %% 5], i, i %% 997))
+'''
+
+CONFIG = '''
+[_default_]
+email_sendmail = /bin/sh -c 'cat > /dev/null'
+email_maxsize = 102400
+
+[true]
+exit_codes = 0
+
+[printer]
+whitelist = ^x+$
+
+[generator]
+required = request 0 took
+whitelist = INFO, DEBUG, WARNING, ERROR, NOTICE
+blacklist = ERROR request [0-9]*7 took, 'took [0-9]{4,}ms', \
+            '(?i)traceback', 'out of memory', 'permission denied', \
+            '^[0-9-]+ [0-9:]+ FATAL', 'request -[0-9]+', 'segfault', \
+            'connection (refused|reset)', 'No such file'
+'''
+
+###############################################################################
+# Benchmark functions
+###############################################################################
+def get_jobs(scale):
+    '''Return the jobs to measure as a list of (tag, command line) tuples'''
+    return [('true', ['/bin/true']),
+            ('printer', [sys.executable, '-c',
+                         PRINTER % max(int(100 * scale), 1)]),
+            ('generator', [sys.executable, '-c',
+                           GENERATOR % max(int(200000 * scale), 1)])]
+
+def measure(args):
+    '''Run a command and return its wall time, CPU time and maximum RSS'''
+    start = time.time()
+    pid = os.fork()
+    if pid == 0:
+        devnull = os.open(os.devnull, os.O_RDWR)
+        os.dup2(devnull, 1)
+        try:
+            os.execv(args[0], args)
+        finally:
+            os._exit(127)
+
+    (pid, status, usage) = os.wait4(pid, 0)
+    wall = time.time() - start
+
+    if os.WEXITSTATUS(status) != 0:
+        raise Exception('%s exited with %i' % (' '.join(args),
+                                               os.WEXITSTATUS(status)))
+
+    # ru_maxrss is in kilobytes on Linux
+    return {'wall': wall, 'cpu': usage.ru_utime + usage.ru_stime,
+            'rss': usage.ru_maxrss / 1024.0}
+
+def run_benchmark(scale = 1.0, repeat = 3):
+    '''Measure each job directly and through cronwatch
+
+       Returns a dictionary with the overhead cronwatch adds to each job'''
+
+    tempdir = mkdtemp()
+    try:
+        config = os.path.join(tempdir, 'cronwatch.conf')
+        open(config, 'w').write(CONFIG)
+
+        results = {}
+        for (tag, args) in get_jobs(scale):
+            watched = [sys.executable, CRONWATCH, '-c', config, '-t', tag,
+                       '-s', os.path.join(tempdir, 'nosocket'), '--'] + args
+
+            # Take the best of the runs to keep the noise down
+            direct = [measure(args) for i in range(repeat)]
+            through = [measure(watched) for i in range(repeat)]
+
+            results[tag] = {}
+            for k in ('wall', 'cpu', 'rss'):
+                results[tag][k] = min([r[k] for r in through]) - \
+                                  min([r[k] for r in direct])
+    finally:
+        rmtree(tempdir)
+
+    return results
+
+def compare(results, baseline, tolerance):
+    '''Compare the results to the baseline
+
+       Returns a list of the measurements that got worse than the tolerance
+       allows'''
+
+    failures = []
+    for tag in sorted(results):
+        if tag not in baseline:
+            continue
+        for k in ('wall', 'cpu', 'rss'):
+            allowed = max(baseline[tag][k], 0) * (1 + tolerance)
+
+            # Leave some slack for measurements that are close to zero
+            allowed += {'wall': 0.05, 'cpu': 0.05, 'rss': 1.0}[k]
+            if results[tag][k] > allowed:
+                failures.append('%s %s: %.3f (baseline %.3f)' %
+                                (tag, k, results[tag][k], baseline[tag][k]))
+    return failures
+
+def main(argv):
+    '''Run the benchmark and check it against the baseline'''
+
+    parser = OptionParser(usage = 'usage: %prog [options]')
+    parser.add_option('-b', '--baseline', default = BASELINE,
+                      help = 'read the baseline from BASELINE')
+    parser.add_option('-u', '--update', action = 'store_true',
+                      default = False,
+                      help = 'store the results as the new baseline')
+    parser.add_option('--tolerance', type = 'float', default = 0.25,
+                      help = 'allowed increase over the baseline ' +
+                             '(default: 0.25)')
+    parser.add_option('--scale', type = 'float', default = 1.0,
+                      help = 'scale the output of the jobs (default: 1.0)')
+    parser.add_option('--repeat', type = 'int', default = 3,
+                      help = 'number of runs of each job (default: 3)')
+
+    (options, args) = parser.parse_args(args = argv)
+
+    # Without a baseline there's nothing to fail against
+    if not options.update and not os.path.exists(options.baseline):
+        print('No baseline in %s, run with --update to store one' %
+              options.baseline)
+        return 2
+
+    results = run_benchmark(options.scale, options.repeat)
+
+    print('%-10s %12s %12s %12s' % ('job', 'wall (s)', 'cpu (s)', 'rss (MB)'))
+    for tag in sorted(results):
+        r = results[tag]
+        print('%-10s %12.3f %12.3f %12.1f' % (tag, r['wall'], r['cpu'],
+                                               r['rss']))
+
+    if options.update:
+        json.dump(results, open(options.baseline, 'w'), indent = 4,
+                  sort_keys = True)
+        print('Wrote the baseline to %s' % options.baseline)
+        return 0
+
+    failures = compare(results, json.load(open(options.baseline)),
+                       options.tolerance)
+    if failures:
+        print('Overhead is above the baseline:')
+        for f in failures:
+            print('  %s' % f)
+        return 1
+
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -19,38 +19,183 @@
 # along with this program; if not, write to the Free Software
 # Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
 
+from __future__ import print_function
+
 import sys
 import os
 import signal
 import subprocess
 import time
+import random
+import math
+import glob
 import re
 import shlex
+import select
+import pickle
+import socket
+import struct
+import errno
+import json
+import fcntl
+import resource
+import functools
+import zlib
 
 from optparse import OptionParser
-from tempfile import TemporaryFile
-from StringIO import StringIO
+from tempfile import TemporaryFile, SpooledTemporaryFile, mkstemp
 from getpass import getuser
 from socket import getfqdn, gethostname
 from datetime import datetime
+from hashlib import sha1
+from gzip import GzipFile
+from shutil import copyfileobj
+from collections import deque
+from io import BytesIO
 
 from configobj import ConfigObj, flatten_errors, get_extra_values
-from validate import Validator, VdtTypeError, VdtValueError, is_list, is_int_list, force_list, ValidateError
-
-
-# This is to fix the name change in Python 2.4 -> 2.5
-import email
-if int(email.__version__[0]) < 4:
-    from email.MIMEText import MIMEText
-    from email.MIMEMultipart import MIMEMultipart
+try:
+    from configobj.validate import Validator, VdtTypeError, VdtValueError, is_list, is_int_list, force_list, ValidateError
+except ImportError:
+    from validate import Validator, VdtTypeError, VdtValueError, is_list, is_int_list, force_list, ValidateError
+
+# The job's output is handled as bytes and only decoded to check it, so that
+# output that isn't valid UTF-8 still gets through unchanged
+PY3 = sys.version_info[0] >= 3
+if PY3:
+    string_types = str
 else:
-    from email.mime.text import MIMEText
-    from email.mime.multipart import MIMEMultipart
+    string_types = basestring
 
 ###############################################################################
 # Global variables
 ###############################################################################
 CONFIGFILE='/etc/cronwatch.conf'
+CONFIGDIR='/etc/cronwatch.d'
+STATEDIR=os.path.join(os.path.expanduser('~'), '.cronwatch')
+
+# SO_PEERCRED is only in the socket module starting with Python 3.3
+SO_PEERCRED = getattr(socket, 'SO_PEERCRED', 17)
+
+# Seconds cronwatchd and a client wait for each other while a job is handed
+# over. A client that can't hand the job over runs it itself.
+DAEMON_TIMEOUT = 10
+
+# How streams are shown in the output when they are captured separately
+STREAM_NAMES = {'O': 'out', 'E': 'err'}
+
+# Time spent in these built-ins is time spent waiting for the job to finish.
+# run() waits for the job in poll() on its pipes. The names are the ones the
+# profiler uses in Python 3 and then in Python 2.
+CHILD_WAIT_FUNCTIONS = ('<built-in method posix.waitpid>',
+                        '<built-in method posix.wait4>',
+                        "<method 'poll' of 'select.poll' objects>",
+                        '<posix.waitpid>', '<posix.wait4>',
+                        '<built-in method poll>')
+
+# Time spent in these built-ins, when they're called by one of the cronwatch
+# functions, is time the job is held back for splay, the lock or a slot
+START_WAIT_FUNCTIONS = ('<built-in method time.sleep>',
+                        '<built-in method fcntl.flock>',
+                        '<time.sleep>', '<fcntl.flock>')
+START_WAIT_CALLERS = ('watch', 'acquire')
+
+# There's no ioprio_set() in the standard library, so call it by number
+IOPRIO_SYSCALLS = {'x86_64': 251, 'i386': 289, 'i686': 289, 'aarch64': 30,
+                   'armv7l': 314, 'ppc64le': 273, 's390x': 282}
+IOPRIO_CLASSES = {'realtime': 1, 'best-effort': 2, 'idle': 3}
+
+# The settings that hold regular expressions
+PATTERN_SETTINGS = ('required', 'whitelist', 'blacklist', 'output_normalize',
+                    'stderr_whitelist', 'stderr_blacklist')
+
+# --check-config times patterns against lines of these lengths, and flags
+# those whose cost grows faster than length ** MAX_GROWTH
+PROBE_LENGTHS = (16, 64, 256, 1024, 4096, 16384)
+MAX_GROWTH = 1.5
+SAMPLE_LINE = '2011-01-01 00:00:00 INFO worker[1234]: request 5678 took ' + \
+              '91ms from 10.0.0.1'
+
+# The host's fully qualified name is looked up at most once in this many
+# seconds, and kept in memory and in STATEDIR/hostname in between
+HOSTNAME_TTL = 86400
+HOSTNAME_CACHE = None
+
+# The resource limit behind each limit_* setting
+RESOURCE_LIMITS = {'limit_cpu': resource.RLIMIT_CPU,
+                   'limit_as': resource.RLIMIT_AS,
+                   'limit_nofile': resource.RLIMIT_NOFILE,
+                   'limit_fsize': resource.RLIMIT_FSIZE}
+
+# Limits that don't have a signal of their own are spotted in the output
+LIMIT_MESSAGES = {'limit_as': re.compile('cannot allocate memory|' +
+                                         'MemoryError|out of memory', re.I),
+                  'limit_nofile': re.compile('too many open files', re.I)}
+
+# The types of error that email_route can send to more recipients, with the
+# start of the messages of each type. The error type matches any error.
+ERROR_TYPES = {'exit_code': ('Exit code ',),
+               'limit': ('Job exceeded limit_', 'Job may have run into '),
+               'stalled': ('No output for ',
+                           'Could not send the stall notification '),
+               'max_capture': ('Output exceeded max_capture ',),
+               'required': ('Required output missing ',),
+               'whitelist': ('Output not matched by whitelist ',),
+               'blacklist': ('Output matched by blacklist ',),
+               'stderr_blacklist': ('stderr matched by stderr_blacklist ',),
+               'skipped': ('Skipped because ',)}
+
+CONFIG_SPEC_DEFAULTS = '''
+    required = force_regex_list(default = list())
+    whitelist = force_regex_list(default = None)
+    blacklist = force_regex_list(default = list())
+    exit_codes = force_int_list(default = list(0))
+    preamble_file = is_readable_file(default = None)
+    email_to = force_list(default = None)
+    email_route = force_route_list(default = list())
+    email_from = string(default = None)
+    email_maxsize = integer(default = 102400, min = -1)
+    email_success = boolean(default = False)
+    email_sendmail = string(default = /usr/lib/sendmail)
+    email_detach = boolean(default = False)
+    logfile = string(default = None)
+    metrics_dir = string(default = None)
+    alert_window = integer(default = 0, min = 0)
+    alert_recovery = boolean(default = False)
+    email_changes = boolean(default = False)
+    email_diff = boolean(default = False)
+    output_normalize = force_regex_list(default = list())
+    email_attach = boolean(default = False)
+    email_attach_maxsize = integer(default = 10485760, min = -1)
+    output_context = integer(default = -1, min = -1)
+    max_capture = integer(default = -1, min = -1)
+    max_capture_kill = boolean(default = False)
+    spool_size = integer(default = 65536, min = 0)
+    capture = option('merged', 'separate', default = 'merged')
+    stderr_whitelist = force_regex_list(default = None)
+    stderr_blacklist = force_regex_list(default = None)
+    idle_timeout = integer(default = 0, min = 0)
+    idle_notify = boolean(default = False)
+    idle_kill = boolean(default = False)
+    lock = option('none', 'skip', 'wait', 'kill-old', default = 'none')
+    max_concurrent = integer(default = 0, min = 0)
+    splay = integer(default = 0, min = 0)
+    splay_mode = option('random', 'hash', default = 'random')
+    nice = integer(default = 0, min = -20, max = 19)
+    ionice_class = option('none', 'realtime', 'best-effort', 'idle', default = 'none')
+    ionice_priority = integer(default = 4, min = 0, max = 7)
+    limit_cpu = integer(default = -1, min = -1)
+    limit_as = integer(default = -1, min = -1)
+    limit_nofile = integer(default = -1, min = -1)
+    limit_fsize = integer(default = -1, min = -1)
+    pattern_stats = boolean(default = False)
+    stats_file = string(default = None)
+    hostname = string(default = None)
+    max_line_length = integer(default = 65536, min = 0)
+    line_overlap = integer(default = 256, min = 0)
+'''
+CONFIG_SPEC = '[__many__]\n%s\n[_default_]\n%s' % (CONFIG_SPEC_DEFAULTS,
+                                                    CONFIG_SPEC_DEFAULTS)
 
 ###############################################################################
 # Exception class(es)
@@ -66,31 +211,308 @@ class Error(Exception):
 ###############################################################################
 # Helper functions
 ###############################################################################
-def get_user_hostname():
-    return '%s@%s' % (getuser(), getfqdn(gethostname()))
+def to_text(data):
+    '''Decode bytes from the job into a native string
+
+       Bytes that aren't valid UTF-8 are kept as surrogates, so to_bytes()
+       gives back exactly what the job printed. On Python 2 the bytes already
+       are the native string.'''
+    if PY3 and isinstance(data, bytes):
+        return data.decode('utf-8', 'surrogateescape')
+    return data
+
+def to_bytes(text):
+    '''Encode a native string the way to_text() decoded it'''
+    if PY3 and isinstance(text, str):
+        return text.encode('utf-8', 'surrogateescape')
+    return text
+
+def write_bytes(fh, data):
+    '''Write bytes to a text stream like sys.stdout
+
+       The bytes go straight to the stream's binary buffer, so they don't have
+       to be valid in its encoding. A stream without one, like a StringIO,
+       gets them decoded with to_text().'''
+    if hasattr(fh, 'buffer'):
+        fh.flush()
+        fh.buffer.write(data)
+    else:
+        fh.write(to_text(data))
+
+def get_hostname():
+    '''Return the host's fully qualified name
+
+       Looking it up can block on DNS, so the answer is cached for
+       HOSTNAME_TTL seconds in memory and in the state directory.'''
+    global HOSTNAME_CACHE
 
-def run(args, timeout = -1):
+    now = time.time()
+    name = gethostname()
+    if HOSTNAME_CACHE is not None and HOSTNAME_CACHE['name'] == name and \
+       now - HOSTNAME_CACHE['time'] < HOSTNAME_TTL:
+        return HOSTNAME_CACHE['fqdn']
+
+    fn = os.path.join(STATEDIR, 'hostname')
+    try:
+        cache = json.loads(open(fn).read())
+        if cache['name'] == name and 0 <= now - cache['time'] < HOSTNAME_TTL:
+            HOSTNAME_CACHE = cache
+            return cache['fqdn']
+    except (IOError, ValueError, KeyError, TypeError):
+        pass
+
+    HOSTNAME_CACHE = {'name': name, 'fqdn': getfqdn(name), 'time': now}
+
+    # A missing cache only costs another lookup, so don't fail the job
+    try:
+        if not os.path.isdir(STATEDIR):
+            os.makedirs(STATEDIR)
+        (fd, tmp) = mkstemp(dir = STATEDIR)
+        os.write(fd, to_bytes(json.dumps(HOSTNAME_CACHE)))
+        os.close(fd)
+        os.rename(tmp, fn)
+    except (IOError, OSError):
+        pass
+
+    return HOSTNAME_CACHE['fqdn']
+
+def get_user_hostname(hostname = None):
+    '''Return user@hostname, using the cached host name unless one is given'''
+    if hostname is None:
+        hostname = get_hostname()
+    return '%s@%s' % (getuser(), hostname)
+
+def spooled_file(spool_size):
+    '''Create a temporary file that is kept in memory until it gets bigger
+       than spool_size bytes
+
+       A spool_size of 0 creates the file on disk right away.'''
+    if spool_size > 0:
+        return SpooledTemporaryFile(max_size = spool_size)
+    return TemporaryFile()
+
+def set_ioprio(ioclass, priority):
+    '''Set the I/O scheduling class and priority of this process'''
+    syscall = IOPRIO_SYSCALLS.get(os.uname()[4])
+    if syscall is None:
+        raise Error('ionice is not supported on %s' % os.uname()[4])
+
+    # Only jobs with ionice set need ctypes, so it isn't loaded at startup
+    import ctypes
+    libc = ctypes.CDLL(None, use_errno = True)
+    # IOPRIO_WHO_PROCESS with a pid of 0 means this process
+    if libc.syscall(syscall, 1, 0, (IOPRIO_CLASSES[ioclass] << 13) |
+                    priority) != 0:
+        raise OSError(ctypes.get_errno(), 'ioprio_set failed')
+
+def setup_child(setsid = False, nice = 0, ionice = None, limits = None):
+    '''Set up the job's process before it's executed
+
+       ionice is a tuple with the class and priority and limits maps
+       resource limits to their values.'''
+    if setsid:
+        os.setsid()
+    if nice:
+        os.nice(nice)
+    if ionice is not None:
+        set_ioprio(*ionice)
+
+    # Python ignores SIGXFSZ and the job would inherit that
+    signal.signal(signal.SIGXFSZ, signal.SIG_DFL)
+
+    # Only the soft limit is set, so a job can catch SIGXCPU and clean up
+    for (r, v) in (limits or {}).items():
+        hard = resource.getrlimit(r)[1]
+        if hard != resource.RLIM_INFINITY and v > hard:
+            v = hard
+        resource.setrlimit(r, (v, hard))
+
+def run(args, timeout = -1, max_capture = -1, discard = None, kill = False,
+        spool_size = 65536, separate = False, idle_timeout = 0,
+        on_idle = None, idle_kill = False, on_start = None,
+        new_session = False, resources = None, max_line_length = 0):
     '''Run an executable
     
+       Only the whole lines in the first max_capture bytes of output are
+       saved. The rest is passed to discard and, if kill is set, the job is
+       killed. The pipes are read until the end either way, so the job never
+       blocks on them.
+
+       If the job doesn't print anything for idle_timeout seconds, on_idle is
+       called with the time since the start of the job and, if idle_kill is
+       set, the job is killed.
+
+       on_start is called with the pid of the job once it has started. If
+       new_session is set, the job gets its own process group. resources is a
+       dictionary of keyword arguments for setup_child().
+
+       With separate set, lines longer than max_line_length are saved in
+       pieces. Every piece but the last has its stream in lower case.
+
+       If separate is set, stdout and stderr are read from separate pipes and
+       each line is saved with the stream it came from and its time offset
+       from the start of the job (see parse_capture_line()).
+
        Returns a tuple with a handle to the output and the error code'''
 
     # Create a temporary file for the output
-    output_file = TemporaryFile()
+    output_file = spooled_file(spool_size)
+
+    # Killing the job needs its own process group to get its children too
+    setsid = kill or idle_kill or new_session
+    popen_args = {}
+    if PY3:
+        # Python 3 can do this without running Python code in the child
+        popen_args['start_new_session'] = setsid
+        setsid = False
+    if setsid or resources:
+        popen_args['preexec_fn'] = functools.partial(setup_child, setsid,
+                                                     **(resources or {}))
+
+    stderr = subprocess.STDOUT
+    if separate:
+        stderr = subprocess.PIPE
 
     try:
-        process = subprocess.Popen(args, stdout = output_file,
-                                   stderr = subprocess.STDOUT,
-                                   stdin = open(os.devnull))
-        if timeout > -1:
-            time.sleep(timeout)
-            os.kill(process.pid, signal.SIGTERM)
-            return_code = -1
+        process = subprocess.Popen(args, stdout = subprocess.PIPE,
+                                   stderr = stderr,
+                                   stdin = open(os.devnull),
+                                   **popen_args)
+    except Exception as e:
+        raise Error('could not run %s: %s' % (args[0], str(e)))
 
-        else:
-            return_code = process.wait()
+    if on_start:
+        on_start(process.pid)
+
+    # Read all of the pipes in this thread, whichever one is ready first
+    streams = {process.stdout.fileno(): b'O'}
+    if separate:
+        streams[process.stderr.fileno()] = b'E'
+
+    partial = {}
+    poller = select.poll()
+    for fd in streams:
+        partial[fd] = b''
+        poller.register(fd, select.POLLIN | select.POLLPRI)
+
+    captured = 0
+    line_start = 0
+    full = False
+    return_code = None
+    killed = False
+
+    start = time.time()
+    if timeout > -1:
+        deadline = start + timeout
+
+    # The poll timeout is the next time something has to happen
+    last_output = start
+    stalled = False
+
+    while streams:
+        now = time.time()
+        waits = []
+        if timeout > -1:
+            if deadline <= now:
+                os.kill(process.pid, signal.SIGTERM)
+                return_code = -1
+                break
+            waits.append(deadline - now)
+
+        if idle_timeout > 0 and not stalled:
+            if last_output + idle_timeout <= now:
+                stalled = True
+                if on_idle:
+                    on_idle(now - start)
+                if idle_kill:
+                    try:
+                        os.killpg(process.pid, signal.SIGTERM)
+                    except OSError:
+                        pass
+                continue
+            waits.append(last_output + idle_timeout - now)
+
+        wait = None
+        if waits:
+            wait = int(min(waits) * 1000) + 1
 
-    except Exception, e:
-        raise Error('could not run %s: %s' % (args[0], str(e)))
+        try:
+            events = poller.poll(wait)
+        except select.error as e:
+            if e.args[0] == errno.EINTR:
+                continue
+            raise
+
+        for (fd, event) in events:
+            data = os.read(fd, 65536)
+            stream = streams[fd]
+            last_output = time.time()
+            stalled = False
+
+            if not data:
+                poller.unregister(fd)
+                del streams[fd]
+
+            # Tag each complete line with its stream and time offset
+            if separate:
+                lines = (partial[fd] + data).split(b'\n')
+                partial[fd] = lines.pop()
+                if not data and partial[fd]:
+                    lines.append(partial[fd])
+                offset = time.time() - start
+                pieces = []
+                for l in lines:
+                    while max_line_length > 0 and len(l) > max_line_length:
+                        pieces.append(b'%s %.3f %s\n' % (stream.lower(),
+                                      offset, l[:max_line_length]))
+                        l = l[max_line_length:]
+                    pieces.append(b'%s %.3f %s\n' % (stream, offset, l))
+
+                # Don't wait forever for the end of a line
+                while max_line_length > 0 and \
+                      len(partial[fd]) > max_line_length:
+                    pieces.append(b'%s %.3f %s\n' % (stream.lower(), offset,
+                                  partial[fd][:max_line_length]))
+                    partial[fd] = partial[fd][max_line_length:]
+                data = b''.join(pieces)
+
+            # Save what fits and hand the rest over to discard
+            if max_capture > -1 and captured + len(data) > max_capture:
+                keep = max(max_capture - captured, 0)
+
+                # A cut line is checked and counted in one piece by discard
+                keep = data.rfind(b'\n', 0, keep) + 1
+                if keep == 0 and not full:
+                    output_file.seek(line_start)
+                    data = output_file.read() + data
+                    output_file.seek(line_start)
+                    output_file.truncate()
+                full = True
+
+                output_file.write(data[:keep])
+                captured = max_capture
+                if discard:
+                    discard(data[keep:])
+
+                if kill and not killed:
+                    killed = True
+                    try:
+                        os.killpg(process.pid, signal.SIGTERM)
+                    except OSError:
+                        pass
+            else:
+                n = data.rfind(b'\n')
+                if n > -1:
+                    line_start = captured + n + 1
+                output_file.write(data)
+                captured += len(data)
+
+    process.stdout.close()
+    if separate:
+        process.stderr.close()
+
+    if return_code is None:
+        return_code = process.wait()
 
     # I'm not sure if the flush is needed, but better safe than sorry
     output_file.flush()
@@ -100,6 +522,43 @@ def run(args, timeout = -1):
 
     return (output_file, return_code)
 
+def parse_capture_line(line):
+    '''Split a line saved by run() with separate set into a tuple with the
+       stream ('O' or 'E', or lower case for a piece of a long line), the time
+       offset and the line itself'''
+    (stream, offset, line) = to_text(line).split(' ', 2)
+    return (stream, float(offset), line)
+
+def read_lines(fh, max_length = 0):
+    '''Read a file by lines, but never more than max_length bytes at a time
+
+       Yields tuples with the line and whether it was cut off, in which case
+       the rest of it comes next. A max_length of 0 means no limit.'''
+    if max_length <= 0:
+        for l in fh:
+            yield (l, False)
+        return
+
+    partial = b''
+    while True:
+        data = fh.read(65536)
+        if not data:
+            break
+        lines = (partial + data).split(b'\n')
+        partial = lines.pop()
+        for l in lines:
+            while len(l) > max_length:
+                yield (l[:max_length], True)
+                l = l[max_length:]
+            yield (l + b'\n', False)
+
+        while len(partial) > max_length:
+            yield (partial[:max_length], True)
+            partial = partial[max_length:]
+
+    if partial:
+        yield (partial, False)
+
 def line_search(line, rx, find_all = False):
     '''Compare a list of regular expressions to a line and return the 
        results'''
@@ -116,6 +575,196 @@ def line_search(line, rx, find_all = False):
     else:
         return (False, [])
 
+def check_line(line, rx, hits):
+    '''Check a line against the required, whitelist and blacklist regular
+       expressions
+
+       rx is a dictionary with the lists of regular expressions and hits is a
+       dictionary with the matching counters, both keyed by the list name.
+       Returns a tuple with the line's flag and whether the whitelist matched
+       it.'''
+
+    flag = ' '
+    listed = True
+
+    # Check for required lines
+    found = line_search(line, rx['required'])
+    for p in found[1]:
+        hits['required'][p] += 1
+
+    # Check for whitelist lines
+    if rx['whitelist'] != None:
+        found = line_search(line, rx['whitelist'])
+        if not found[0]:
+            listed = False
+            flag = '*'
+        for p in found[1]:
+            hits['whitelist'][p] += 1
+
+    # Check for blacklist lines
+    found = line_search(line, rx['blacklist'])
+    if found[0]:
+        for p in found[1]:
+            hits['blacklist'][p] += 1
+        flag = '!'
+
+    return (flag, listed)
+
+def check_piece(line, rx, hits, seen, last = False):
+    '''Check a piece of a line that was cut up like check_line()
+
+       seen holds the (list name, pattern) pairs that hit an earlier piece of
+       the same line, so that each pattern only counts once per line. The
+       whitelist only has to match one of the pieces, so that's decided on
+       the last piece, and only that one gets flagged if none matched.'''
+    piece = dict([(name, dict.fromkeys(hits[name], 0)) for name in hits])
+    (flag, listed) = check_line(line, rx, piece)
+    for name in piece:
+        for p in piece[name]:
+            if piece[name][p] and (name, p) not in seen:
+                seen.add((name, p))
+                hits[name][p] += 1
+
+    if listed:
+        seen.add(('whitelist', None))
+    if flag == '*':
+        flag = ' '
+    if last and ('whitelist', None) not in seen:
+        if flag == ' ':
+            flag = '*'
+        return (flag, False)
+    return (flag, True)
+
+class TimedRegex(object):
+    '''Regular expression that keeps stats on the searches done with it
+
+       stats is a list with the number of searches, the time they took, the
+       number of matches and the first and last matching line numbers, which
+       are read from position[0].'''
+    def __init__(self, rx, stats, position = None):
+        self.rx = rx
+        self.pattern = rx.pattern
+        self.stats = stats
+        self.position = position
+
+    def search(self, line):
+        start = time.time()
+        m = self.rx.search(line)
+        s = self.stats
+        s[0] += 1
+        s[1] += time.time() - start
+        if m:
+            s[2] += 1
+            if self.position is not None:
+                if s[3] is None:
+                    s[3] = self.position[0]
+                s[4] = self.position[0]
+        return m
+
+def wrap_patterns(rx, stats, position = None):
+    '''Replace the lists of regular expressions in rx with TimedRegexes
+
+       stats maps each list name and pattern to the TimedRegex stats and is
+       filled in as needed.'''
+    timed = {}
+    for (name, rxs) in rx.items():
+        if rxs is None:
+            timed[name] = None
+            continue
+        timed[name] = []
+        for r in rxs:
+            s = stats.setdefault((name, r.pattern), [0, 0.0, 0, None, None])
+            timed[name].append(TimedRegex(r, s, position))
+    return timed
+
+class OutputCounter(object):
+    '''Keep the counters up to date for output that isn't saved
+
+       If rx_err and hits_err are given, the output is in the format saved by
+       run() with separate set and they're used for the stderr lines. Only
+       the text of each line counts towards bytes, not its prefix. Lines
+       longer than max_line_length are checked in pieces, but only count as
+       one line.'''
+    def __init__(self, rx, hits, rx_err = None, hits_err = None,
+                 max_line_length = 0):
+        self.rx = rx
+        self.hits = hits
+        self.rx_err = rx_err
+        self.hits_err = hits_err
+        self.max_line_length = max_line_length
+        self.lines = 0
+        self.bytes = 0
+        self.listed = True
+        self.partial = b''
+        self.cut = {}
+        self.seen = {}
+
+    def feed(self, data):
+        '''Count the lines in a chunk of output'''
+        lines = (self.partial + data).split(b'\n')
+        self.partial = lines.pop()
+        for l in lines:
+            self.check(l + b'\n')
+
+        # Don't wait forever for the end of a line
+        m = self.max_line_length
+        while m > 0 and len(self.partial) > m:
+            self.check(self.partial[:m], True)
+            self.partial = self.partial[m:]
+
+    def close(self):
+        '''Count the last line if it didn't end with a newline'''
+        if self.partial:
+            self.check(self.partial)
+            self.partial = b''
+
+    def check(self, raw, cut = False):
+        line = l = to_text(raw)
+        (rx, hits) = (self.rx, self.hits)
+        stream = 'O'
+        if self.rx_err is not None:
+            (stream, offset, line) = parse_capture_line(l)
+            if stream.islower():
+                (stream, cut, line) = (stream.upper(), True, line[:-1])
+            if stream == 'E':
+                (rx, hits) = (self.rx_err, self.hits_err)
+
+        # Only the text after the ASCII prefix counts, in bytes
+        self.bytes += len(raw) - len(l) + len(line)
+
+        continued = self.cut.get(stream, False)
+        self.cut[stream] = cut
+        if not continued:
+            self.lines += 1
+            self.seen[stream] = set()
+
+        if cut or continued:
+            listed = check_piece(line, rx, hits, self.seen[stream],
+                                 not cut)[1]
+        else:
+            listed = check_line(line, rx, hits)[1]
+        if not listed:
+            self.listed = False
+
+class StallHandler(object):
+    '''Keep track of when a job stalls and send a notification right away
+
+       mail is a tuple with the arguments for send_mail(), or None to not
+       send anything. The job is still running, so errors sending the mail
+       are only kept in errors.'''
+    def __init__(self, mail = None):
+        self.mail = mail
+        self.stalls = []
+        self.errors = []
+
+    def __call__(self, offset):
+        self.stalls.append(offset)
+        if self.mail is not None:
+            try:
+                send_mail(*self.mail)
+            except Error as e:
+                self.errors.append(e)
+
 class VdtValueMsgError(VdtValueError):
     def __init__(self, msg):
         ValidateError.__init__(self, msg)
@@ -124,19 +773,19 @@ def is_readable_file(value):
     '''Validator check for a file'''
     try:
         open(value)
-    except Exception, e:
+    except Exception as e:
         raise VdtValueMsgError('could not read file: %s' % e)
 
     return value
 
 def is_regex(value):
     '''Validator check for regular expressions'''
-    if not isinstance(value, basestring):
+    if not isinstance(value, string_types):
         raise VdtTypeError(value)
 
     try: 
         r = re.compile(value)
-    except Exception, e:
+    except Exception as e:
         raise VdtValueMsgError('invalid regular expression: %s: %s' % 
                                (value, e))
 
@@ -154,6 +803,26 @@ def force_int_list(value):
     '''Validator check to force as list of integers'''
     return is_int_list(force_list(value))
 
+def force_route_list(value):
+    '''Validator check to force a list of "error type: address" routes
+
+       Returns a list of (error type, address) tuples'''
+    routes = []
+    for r in force_list(value):
+        if not isinstance(r, string_types):
+            raise VdtTypeError(r)
+
+        (kind, sep, addr) = r.partition(':')
+        (kind, addr) = (kind.strip(), addr.strip())
+        if not sep or not addr:
+            raise VdtValueMsgError('invalid route, expected ' +
+                                   '"error type: address": %s' % r)
+        if kind != 'error' and kind not in ERROR_TYPES:
+            raise VdtValueMsgError('unknown error type: %s' % kind)
+        routes.append((kind, addr))
+
+    return routes
+
 def compile_re(regex):
     '''Compile a regex or list of regexes'''
 
@@ -161,52 +830,37 @@ def compile_re(regex):
     for r in regex:
         try:
             l.append(re.compile(r))
-        except TypeError, e:
+        except TypeError as e:
             raise Error('must be a string or list of strings')
 
     return l
 
-def read_config(config_file = None):
-    '''Read the configuration file'''
-    
-    # Set up the validation spec
-    config_spec = StringIO()
-    defaults = '''
-        required = force_regex_list(default = list())
-        whitelist = force_regex_list(default = None)
-        blacklist = force_regex_list(default = list())
-        exit_codes = force_int_list(default = list(0))
-        preamble_file = is_readable_file(default = None)
-        email_to = string(default = None)
-        email_from = string(default = None)
-        email_maxsize = integer(default = 102400, min = -1)
-        email_success = boolean(default = False)
-        email_sendmail = string(default = /usr/lib/sendmail)
-        logfile = string(default = None)
-    '''
-    config_spec.write('[__many__]\n%s\n[_default_]\n%s' % (defaults, defaults))
-    config_spec.seek(0)
+def parse_config(config_file, file_error = True):
+    '''Parse and validate a single configuration file
 
-    if config_file is None:
-        file_error = False
-        config_file = CONFIGFILE
-    else:
-        file_error = True
+       Returns a tuple with the configuration and a list of the sections that
+       were actually defined in the file'''
 
+    # Set up the validation spec
+    config_spec = CONFIG_SPEC.splitlines()
 
     # Read the configuration
     try:
         config = ConfigObj(config_file, configspec = config_spec,
                            file_error = file_error)
-    except IOError, e:
+    except IOError as e:
         raise Error(str(e))
-    except Exception, e:
+    except Exception as e:
         raise Error('could not read %s: %s' % (config_file, e))
 
+    # Validation adds the _default_ section, so remember what was there first
+    sections = list(config.sections)
+
     # Validate the configuration
     extra_checks = { 'is_readable_file': is_readable_file,
                      'force_regex_list': force_regex_list,
-                     'force_int_list': force_int_list}
+                     'force_int_list': force_int_list,
+                     'force_route_list': force_route_list}
     results = config.validate(Validator(extra_checks), preserve_errors = True)
 
     if results != True:
@@ -218,6 +872,105 @@ def read_config(config_file = None):
     extra = get_extra_values(config)
     if extra != []:
         raise Error('unknown setting in configuration: %s' % extra[0][1])
+
+    # All of the jobs on the host share one pool of slots
+    for name in sections:
+        if name != '_default_' and 'max_concurrent' not in \
+           config[name].defaults:
+            raise Error('configuration error for %s.max_concurrent: ' % name +
+                        'it can only be set in the _default_ section')
+
+    return (config, sections)
+
+def get_cache_file(config_file):
+    '''Return the name of the cache file for a configuration file'''
+    name = sha1(to_bytes(os.path.abspath(config_file))).hexdigest()
+    return os.path.join(STATEDIR, 'config', name)
+
+def read_cached_config(config_file):
+    '''Parse a configuration file from a configuration directory
+
+       The validated sections are cached under STATEDIR and reused for as long
+       as the file's modification time and size don't change.
+
+       Returns a dictionary of the sections defined in the file'''
+
+    try:
+        st = os.stat(config_file)
+    except OSError as e:
+        raise Error('could not read %s: %s' % (config_file, e))
+
+    # Python 2 can't read the pickles of Python 3, and 3 may misread 2's
+    key = (st.st_mtime, st.st_size, sha1(to_bytes(CONFIG_SPEC)).hexdigest(),
+           sys.version_info[0])
+    cache_file = get_cache_file(config_file)
+
+    # A missing or corrupt cache just means that the file is parsed again
+    try:
+        (cache_key, sections) = pickle.load(open(cache_file, 'rb'))
+        if cache_key == key:
+            return sections
+    except Exception:
+        pass
+
+    (config, names) = parse_config(config_file)
+    sections = {}
+    for name in names:
+        sections[name] = dict(config[name])
+
+    # Failing to write the cache shouldn't stop the job from running
+    try:
+        cache_dir = os.path.dirname(cache_file)
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        (fd, tmp) = mkstemp(dir = cache_dir)
+        f = os.fdopen(fd, 'wb')
+        pickle.dump((key, sections), f, pickle.HIGHEST_PROTOCOL)
+        f.close()
+        os.rename(tmp, cache_file)
+    except Exception:
+        pass
+
+    return sections
+
+def read_config(config_file = None, config_dir = None):
+    '''Read the configuration file and the configuration directory'''
+    
+    if config_file is None:
+        file_error = False
+        config_file = CONFIGFILE
+
+        # The default directory is only read along with the default file
+        if config_dir is None and os.path.isdir(CONFIGDIR):
+            config_dir = CONFIGDIR
+    else:
+        file_error = True
+
+    (config, names) = parse_config(config_file, file_error)
+
+    if config_dir is None:
+        return config
+
+    try:
+        files = sorted(os.listdir(config_dir))
+    except OSError as e:
+        raise Error('could not read %s: %s' % (config_dir, e))
+
+    # Add the sections from each of the *.conf files in the directory
+    defined = dict([(name, config_file) for name in names])
+    for f in files:
+        if f.startswith('.') or not f.endswith('.conf'):
+            continue
+
+        fn = os.path.join(config_dir, f)
+        sections = read_cached_config(fn)
+        for name in sorted(sections):
+            if name in defined:
+                raise Error('section %s in %s is already defined in %s' %
+                            (name, fn, defined[name]))
+            defined[name] = fn
+            config[name] = sections[name]
+
     return config
 
 def call_sendmail(args, mail):
@@ -225,7 +978,7 @@ def call_sendmail(args, mail):
     
     # Write the mail to a file
     mail_file = TemporaryFile()
-    mail_file.write(mail);
+    mail_file.write(to_bytes(mail))
     mail_file.flush()
     mail_file.seek(0)
 
@@ -233,7 +986,7 @@ def call_sendmail(args, mail):
         process = subprocess.Popen(args, stdout = subprocess.PIPE,
                                    stderr = subprocess.STDOUT,
                                    stdin = mail_file.fileno())
-    except Exception, e:
+    except Exception as e:
         del mail_file
         raise Error('could not run sendmail: %s: %s' % (args[0], str(e)))
     
@@ -241,66 +994,921 @@ def call_sendmail(args, mail):
     r = process.returncode
 
     if r != 0:
-        raise Error('sendmail returned exit code %i: %s' % (r, o))
+        raise Error('sendmail returned exit code %i: %s' % (r, to_text(o)))
+
+def make_mime_text(text, subtype = 'plain'):
+    '''Create a MIME part for text that may not be valid in any encoding
+
+       Plain ASCII goes out as it is. Anything else is sent as UTF-8, with
+       the bytes that aren't valid UTF-8 replaced.'''
+    # The email package takes a while to load, and most runs don't send mail
+    from email.mime.text import MIMEText
+
+    data = to_bytes(text)
+    try:
+        data.decode('ascii')
+        return MIMEText(text, subtype)
+    except UnicodeError:
+        text = data.decode('utf-8', 'replace')
+        if not PY3:
+            text = text.encode('utf-8')
+        return MIMEText(text, subtype, 'utf-8')
 
 def send_mail(sendmail, subject, text, to_addr = None, from_addr = None,
-              html = None):
-    '''Format and send an e-mail'''
+              html = None, attachment = None, deliver = None):
+    '''Format and send an e-mail
+
+       attachment is an optional tuple with the file name and an open file
+       with gzip compressed data. to_addr is an address or a list of them;
+       one message goes to all of them. If deliver is given, it's called
+       instead of call_sendmail() to hand the message over, like MailDelivery
+       does.'''
+    from email.mime.multipart import MIMEMultipart
+    from email.mime.base import MIMEBase
+    from email.encoders import encode_base64
 
     if from_addr is None:
         from_addr = get_user_hostname()
 
     if to_addr is None:
         to_addr = getuser()
+    if isinstance(to_addr, string_types):
+        to_addr = [to_addr]
 
     if html is None:
-        msg = MIMEText(text)
+        body = make_mime_text(text)
     else:
-        msg = MIMEMultipart('alternative')
+        body = MIMEMultipart('alternative')
+        body.attach(make_mime_text(text, 'plain'))
+        body.attach(make_mime_text(html, 'html'))
 
-    msg['To'] = to_addr
+    if attachment is None:
+        msg = body
+    else:
+        msg = MIMEMultipart('mixed')
+        msg.attach(body)
+
+        part = MIMEBase('application', 'gzip')
+        part.set_payload(attachment[1].read())
+        encode_base64(part)
+        part.add_header('Content-Disposition', 'attachment',
+                        filename = attachment[0])
+        msg.attach(part)
+
+    msg['To'] = ', '.join(to_addr)
     msg['From'] = from_addr
     msg['Subject'] = subject
 
-    if not html is None:
-        msg.attach(MIMEText(text, 'plain'))
-        msg.attach(MIMEText(html, 'html'))
+    (deliver or call_sendmail)(shlex.split(sendmail) + list(to_addr),
+                               msg.as_string())
+
+def compress_output(oh, maxsize = -1, spool_size = 65536):
+    '''Compress a file for attaching it to an e-mail
+
+       Compression stops before the compressed data goes over maxsize bytes.
+       Returns a tuple with a file with the compressed data and a flag telling
+       if it was truncated.'''
+
+    compressed = spooled_file(spool_size)
+    gz = GzipFile(fileobj = compressed, mode = 'wb')
+
+    # The compressor holds on to some of the data, so the file only shows
+    # the real size after a flush. Until then, assume the worst, which is a
+    # little more than the size of the data (see zlib's deflateBound()).
+    worst = lambda n: n + n // 1000 + 64
+
+    truncated = False
+    pending = 0
+    while True:
+        size = 65536
+        if maxsize > -1:
+            room = maxsize - compressed.tell() - worst(pending)
+            if room < size and pending:
+                gz.flush()
+                pending = 0
+                room = maxsize - compressed.tell() - worst(0)
+
+            # Close to maxsize, every chunk takes up to half the room left
+            size = min(size, room // 2)
+            if size < 64:
+                truncated = len(oh.read(1)) > 0
+                break
+
+        data = oh.read(size)
+        if not data:
+            break
+        gz.write(data)
+        pending += len(data)
+
+    gz.close()
+    compressed.flush()
+    compressed.seek(0)
+
+    return (compressed, truncated)
+
+def escape_label(value):
+    '''Escape a Prometheus label value'''
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def write_metrics(metrics_dir, tag, metrics, hits):
+    '''Write the metrics for a job to a node_exporter textfile
+
+       Each tag has its own file, which is replaced atomically, so jobs don't
+       have to rewrite each other's metrics.'''
+
+    label = 'tag="%s"' % escape_label(tag)
+    text = ''
+    for name in sorted(metrics):
+        text += '# TYPE cronwatch_%s gauge\n' % name
+        text += 'cronwatch_%s{%s} %s\n' % (name, label, repr(metrics[name]))
+
+    text += '# TYPE cronwatch_pattern_hits gauge\n'
+    for t in sorted(hits):
+        for p in sorted(hits[t]):
+            text += 'cronwatch_pattern_hits{%s,type="%s",pattern="%s"} %i\n' % \
+                    (label, t, escape_label(p), hits[t][p])
+
+    name = 'cronwatch_%s.prom' % re.sub('[^A-Za-z0-9_.-]', '_', tag)
+
+    # node_exporter only reads *.prom, so it never sees the partial file
+    try:
+        (fd, tmp) = mkstemp(dir = metrics_dir, suffix = '.tmp')
+        f = os.fdopen(fd, 'w')
+        f.write(text)
+        f.close()
+        os.chmod(tmp, 0o644)
+        os.rename(tmp, os.path.join(metrics_dir, name))
+    except (IOError, OSError) as e:
+        raise Error('could not write metrics to %s: %s' % (metrics_dir, e))
+
+def format_pattern_stats(stats):
+    '''Return a table of the pattern stats, with the slowest pattern first'''
+    text = 'Pattern stats:\n'
+    text += '  %-16s %8s %8s %8s %10s  %s\n' % ('list', 'hits', 'first',
+                                                 'last', 'time (s)', 'pattern')
+    for (name, pattern) in sorted(stats, key = lambda k: stats[k][1],
+                                  reverse = True):
+        (n, t, h, first, last) = stats[(name, pattern)]
+        text += '  %-16s %8i %8s %8s %10.4f  %s\n' % (name, h,
+                first is None and '-' or first, last is None and '-' or last,
+                t, pattern)
+    return text
+
+def write_pattern_stats(fn, tag, timestamp, lines, stats):
+    '''Add a line of JSON with a run's pattern stats to a file'''
+    patterns = []
+    for (name, pattern) in sorted(stats):
+        (n, t, h, first, last) = stats[(name, pattern)]
+        patterns.append({'list': name, 'pattern': pattern, 'searches': n,
+                         'seconds': t, 'hits': h, 'first': first,
+                         'last': last})
+    try:
+        f = open(fn, 'a')
+        f.write(json.dumps({'tag': tag, 'timestamp': timestamp,
+                            'lines': lines, 'patterns': patterns}) + '\n')
+        f.close()
+    except IOError as e:
+        raise Error('could not write pattern stats to %s: %s' % (fn, e))
+
+def get_alert_digest(fingerprint, errors):
+    '''Finish the fingerprint of a failure with its errors
+
+       Numbers in the errors are ignored, so they don't make the same failure
+       look new. Returns None if there were no errors.'''
+    if not errors:
+        return None
+    for e in errors:
+        fingerprint.update(to_bytes(re.sub('[0-9]+', '#', e) + '\n'))
+    return fingerprint.hexdigest()
+
+def check_alert(tag, fingerprint, window, now = None):
+    '''Record a run in the alert state file
+
+       fingerprint identifies the failure and is None if the run was
+       successful. Repeats of a failure within window seconds of the last mail
+       are suppressed. Returns a tuple with the action (None, 'new', 'repeat',
+       'suppress' or 'recovered'), the number of failures and when the first
+       one happened.'''
+
+    if now is None:
+        now = time.time()
+
+    fn = os.path.join(STATEDIR, 'alerts')
+    try:
+        if not os.path.isdir(STATEDIR):
+            os.makedirs(STATEDIR)
+        f = open(fn, 'a+')
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+    except (IOError, OSError) as e:
+        raise Error('could not open alert state %s: %s' % (fn, e))
+
+    try:
+        f.seek(0)
+        try:
+            state = json.loads(f.read())
+        except ValueError:
+            state = {}
+
+        last = state.get(tag)
+        if fingerprint is None:
+            if last is None:
+                return (None, 0, None)
+            del state[tag]
+            action = 'recovered'
+        elif last is None or last['fingerprint'] != fingerprint:
+            last = state[tag] = {'fingerprint': fingerprint, 'first': now,
+                                 'sent': now, 'count': 1}
+            action = 'new'
+        else:
+            last['count'] += 1
+            if now - last['sent'] < window:
+                action = 'suppress'
+            else:
+                last['sent'] = now
+                action = 'repeat'
+
+        f.seek(0)
+        f.truncate()
+        f.write(json.dumps(state))
+        f.flush()
+    finally:
+        f.close()
+
+    first = datetime.fromtimestamp(last['first']).strftime('%c')
+    return (action, last['count'], first)
+
+def get_output_file(tag):
+    '''Return the name of the file that keeps a tag's last output'''
+    return os.path.join(STATEDIR, 'output', 
+                        re.sub('[^A-Za-z0-9_.-]', '_', tag) + '.gz')
+
+def get_previous_output(tag):
+    '''Return a tuple with the hash and the file name of the last output
+
+       The hash is None if there is no previous output.'''
+
+    fn = get_output_file(tag)
+    try:
+        return (open(fn + '.sha1').read(), fn)
+    except IOError:
+        return (None, fn)
 
-    call_sendmail(shlex.split(sendmail) + [to_addr], msg.as_string())
+def save_output(tag, oh, digest):
+    '''Compress and save the output of a run for the next one'''
+
+    fn = get_output_file(tag)
+    try:
+        d = os.path.dirname(fn)
+        if not os.path.isdir(d):
+            os.makedirs(d)
+
+        (fd, tmp) = mkstemp(dir = d)
+        f = os.fdopen(fd, 'wb')
+        gz = GzipFile(fileobj = f, mode = 'wb')
+        copyfileobj(oh, gz)
+        gz.close()
+        f.close()
+        os.rename(tmp, fn)
+
+        (fd, tmp) = mkstemp(dir = d)
+        f = os.fdopen(fd, 'w')
+        f.write(digest)
+        f.close()
+        os.rename(tmp, fn + '.sha1')
+    except (IOError, OSError) as e:
+        raise Error('could not save the output to %s: %s' % (fn, e))
 
 def get_now():
     '''Return a string with the current date and time'''
     return datetime.now().strftime('%c')
 
+def get_splay(tag, maximum, mode):
+    '''Return how many seconds to hold back the start of a job
+
+       The "hash" mode gives each host and tag the same delay on every run,
+       while "random" picks a new one each time.'''
+    if maximum <= 0:
+        return 0
+    if mode == 'hash':
+        h = sha1(to_bytes('%s %s' % (gethostname(), tag))).hexdigest()
+        return int(h[:8], 16) * maximum / float(0xffffffff)
+    return random.uniform(0, maximum)
+
+###############################################################################
+# Locking functions
+###############################################################################
+def open_lock_file(fn):
+    '''Open a lock file without letting the job inherit it'''
+    try:
+        if not os.path.isdir(os.path.dirname(fn)):
+            os.makedirs(os.path.dirname(fn))
+        f = open(fn, 'a+')
+    except (IOError, OSError) as e:
+        raise Error('could not open lock file %s: %s' % (fn, e))
+    flags = fcntl.fcntl(f.fileno(), fcntl.F_GETFD)
+    fcntl.fcntl(f.fileno(), fcntl.F_SETFD, flags | fcntl.FD_CLOEXEC)
+    return f
+
+def try_lock(f):
+    '''Try to take an exclusive lock without waiting for it'''
+    try:
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        return True
+    except IOError as e:
+        if e.errno not in (errno.EAGAIN, errno.EACCES):
+            raise
+        return False
+
+def is_running(pid):
+    '''Check whether a process is still around'''
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno != errno.ESRCH
+    return True
+
+class JobLock(object):
+    '''Lock that keeps two copies of the same job from running at once
+
+       The lock file holds the pid of the job while it runs, so a new copy
+       can kill the old one.'''
+    def __init__(self, tag):
+        self.fn = os.path.join(STATEDIR, 'locks',
+                               re.sub('[^A-Za-z0-9_.-]', '_', tag))
+        self.f = None
+        self.waited = 0
+        self.holder = None
+
+    def acquire(self, mode):
+        '''Take the lock
+
+           mode says what to do when another copy holds it: "skip" gives up,
+           "wait" waits for the other copy to finish and "kill-old" kills it.
+           Returns False if the run should be skipped.'''
+        start = time.time()
+        f = open_lock_file(self.fn)
+        if not try_lock(f):
+            f.seek(0)
+            try:
+                self.holder = int(f.read().strip())
+            except ValueError:
+                self.holder = None
+
+            if mode == 'skip':
+                f.close()
+                return False
+
+            # The job runs in its own process group, so kill all of it
+            if mode == 'kill-old' and self.holder is not None:
+                try:
+                    os.killpg(self.holder, signal.SIGTERM)
+                except OSError:
+                    pass
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+
+        self.f = f
+        self.waited = time.time() - start
+        return True
+
+    def set_pid(self, pid):
+        '''Record the pid of the job that holds the lock'''
+        self.f.seek(0)
+        self.f.truncate()
+        self.f.write('%i\n' % pid)
+        self.f.flush()
+
+    def release(self):
+        '''Give up the lock'''
+        if self.f is not None:
+            self.f.seek(0)
+            self.f.truncate()
+            self.f.close()
+            self.f = None
+
+class SlotPool(object):
+    '''Host-wide pool of slots that limits how many jobs run at once
+
+       Jobs waiting for a slot line up in a queue file, and only the one at
+       the head of the queue may take a free slot, so they get them in the
+       order they asked for them.'''
+    def __init__(self, size, interval = 0.1):
+        self.dir = os.path.join(STATEDIR, 'slots')
+        self.size = size
+        self.interval = interval
+        self.f = None
+        self.waited = 0
+
+    def update_queue(self, add = None, remove = None):
+        '''Add or remove a pid from the queue and return the queue
+
+           Pids of processes that died while waiting are dropped.'''
+        q = open_lock_file(os.path.join(self.dir, 'queue'))
+        try:
+            fcntl.flock(q.fileno(), fcntl.LOCK_EX)
+            q.seek(0)
+            try:
+                queue = json.loads(q.read())
+            except ValueError:
+                queue = []
+            queue = [p for p in queue if p != remove and is_running(p)]
+            if add is not None:
+                queue.append(add)
+            q.seek(0)
+            q.truncate()
+            q.write(json.dumps(queue))
+            q.flush()
+            return queue
+        finally:
+            q.close()
+
+    def take_slot(self):
+        '''Try to take any free slot'''
+        for i in range(self.size):
+            f = open_lock_file(os.path.join(self.dir, 'slot.%i' % i))
+            if try_lock(f):
+                self.f = f
+                return True
+            f.close()
+        return False
+
+    def acquire(self):
+        '''Wait for a slot'''
+        start = time.time()
+        pid = os.getpid()
+        queue = self.update_queue(add = pid)
+        while not (queue[0] == pid and self.take_slot()):
+            time.sleep(self.interval)
+            queue = self.update_queue()
+            self.waited = time.time() - start
+        self.update_queue(remove = pid)
+
+    def release(self):
+        '''Give the slot back'''
+        if self.f is not None:
+            self.f.close()
+            self.f = None
+
+def start_log_entry(logfile):
+    '''Lock the log file for a new entry and return where the entry starts
+
+       The lock keeps entries from jobs that share the log file apart.'''
+    fcntl.flock(logfile.fileno(), fcntl.LOCK_EX)
+    logfile.seek(0, 2)
+    return logfile.tell()
+
+def finish_log_entry(logfile, offset, entry):
+    '''Add an entry to the log file's index and unlock the log file
+
+       entry is a dictionary with the tag, the start and end times, the exit
+       code and the errors of the run.'''
+    logfile.flush()
+    entry = dict(entry)
+    entry['offset'] = offset
+    entry['length'] = logfile.tell() - offset
+    index = open(get_index_file(logfile.name), 'a')
+    index.write(json.dumps(entry) + '\n')
+    index.close()
+    fcntl.flock(logfile.fileno(), fcntl.LOCK_UN)
+
+def get_index_file(logfile):
+    '''Return the name of the index for a log file'''
+    return logfile + '.idx'
+
+###############################################################################
+# Mail delivery functions
+###############################################################################
+def get_error_types(errors):
+    '''Return the set of error types of a list of errors'''
+    types = set()
+    for e in errors:
+        types.add('error')
+        for kind in ERROR_TYPES:
+            if e.startswith(ERROR_TYPES[kind]):
+                types.add(kind)
+    return types
+
+def get_recipients(to_addr, routes, types):
+    '''Return who gets a message about errors of the given types
+
+       The addresses of the matching routes are added to to_addr, the list
+       from email_to, and each address is only listed once, so one message
+       goes to all of them. Returns None if there's no one but the default
+       recipient.'''
+    extra = [addr for (kind, addr) in routes if kind in types]
+    if to_addr is None:
+        if not extra:
+            return None
+        to_addr = [getuser()]
+
+    recipients = []
+    for addr in list(to_addr) + extra:
+        if addr not in recipients:
+            recipients.append(addr)
+    return recipients
+
+def get_mail_queue():
+    '''Return the directory that holds the mail waiting to be delivered'''
+    return os.path.join(STATEDIR, 'mailqueue')
+
+def queue_mail(args, mail):
+    '''Save a message for a later delivery to retry and return its file name
+
+       The names sort in the order the messages were queued.'''
+    d = get_mail_queue()
+    if not os.path.isdir(d):
+        os.makedirs(d)
+
+    # The message only shows up in the queue once it's complete
+    (fd, tmp) = mkstemp(dir = d, prefix = '.')
+    f = os.fdopen(fd, 'w')
+    f.write(json.dumps({'args': args, 'mail': mail}))
+    f.close()
+    fn = os.path.join(d, '%.6f.%i' % (time.time(), os.getpid()))
+    os.rename(tmp, fn)
+    return fn
+
+def get_queued_mail():
+    '''Return the file names of the queued messages, oldest first'''
+    d = get_mail_queue()
+    try:
+        files = os.listdir(d)
+    except OSError:
+        return []
+    return [os.path.join(d, f) for f in sorted(files) if not f.startswith('.')]
+
+def flush_mail_queue():
+    '''Deliver the queued messages, oldest first
+
+       Stops at the first message that fails, since the rest would most
+       likely fail too. Only one process flushes the queue at a time. Returns
+       a tuple with the number of messages delivered and the error, if any.'''
+    lock = open_lock_file(os.path.join(get_mail_queue(), '.lock'))
+    try:
+        if not try_lock(lock):
+            return (0, None)
+
+        sent = 0
+        for fn in get_queued_mail():
+            try:
+                m = json.loads(open(fn).read())
+            except (IOError, ValueError):
+                # Keep a broken message around, but out of the way
+                os.rename(fn, os.path.join(os.path.dirname(fn),
+                                           '.' + os.path.basename(fn)))
+                continue
+
+            try:
+                call_sendmail(m['args'], m['mail'])
+            except Error as e:
+                return (sent, e)
+            os.unlink(fn)
+            sent += 1
+
+        return (sent, None)
+    finally:
+        lock.close()
+
+def detach(func, *args):
+    '''Call a function in a grandchild process and return without waiting
+
+       The grandchild has its own session and none of this process' files, so
+       neither cron nor a cronwatch client waits for it to finish.'''
+    pid = os.fork()
+    if pid != 0:
+        try:
+            os.waitpid(pid, 0)
+        except OSError:
+            pass
+        return
+
+    try:
+        os.setsid()
+        if os.fork() == 0:
+            devnull = os.open(os.devnull, os.O_RDWR)
+            for fd in (0, 1, 2):
+                os.dup2(devnull, fd)
+            os.closerange(3, os.sysconf('SC_OPEN_MAX'))
+            func(*args)
+    finally:
+        os._exit(0)
+
+class MailDelivery(object):
+    '''Hand mail over to sendmail in the background
+
+       An instance is called like call_sendmail(), but returns right away.
+       Mail that can't be delivered is queued and retried by the next
+       delivery. The outcome is added to logfile, if it isn't None.'''
+    def __init__(self, tag, logfile = None):
+        self.tag = tag
+        self.logfile = logfile
+
+    def __call__(self, args, mail):
+        detach(self.deliver, args, mail)
+
+    def retry(self):
+        '''Deliver the queued mail in the background, if there is any'''
+        if get_queued_mail():
+            detach(self.deliver)
+
+    def deliver(self, args = None, mail = None):
+        '''Deliver a message and then the queued mail'''
+        outcome = []
+        if mail is not None:
+            try:
+                call_sendmail(args, mail)
+                outcome.append('delivered')
+            except Error as e:
+                try:
+                    fn = queue_mail(args, mail)
+                    outcome.append('failed (%s), queued as %s' %
+                                   (e, os.path.basename(fn)))
+                except (IOError, OSError) as qe:
+                    outcome.append('failed (%s) and could not be queued: %s'
+                                   % (e, qe))
+                self.log(outcome)
+                return
+
+        if get_queued_mail():
+            (sent, e) = flush_mail_queue()
+            if sent:
+                outcome.append('%i queued messages delivered' % sent)
+            if e is not None:
+                outcome.append('queued mail still failing (%s)' % e)
+        self.log(outcome)
+
+    def log(self, outcome):
+        '''Add the outcome of a delivery to the log file'''
+        if self.logfile is None or not outcome:
+            return
+        f = open(self.logfile, 'ab')
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        f.write(to_bytes('Mail for %s at %s: %s\n\n' %
+                         (self.tag, get_now(), '; '.join(outcome))))
+        f.close()
+
 ###############################################################################
 # Watch function
 ###############################################################################
-def watch(args, config = None, tag = None, force_blacklist = True):
-    '''Watch a job and capture output'''
+def skip_job(args, config, section, tag, subject, holder, deliver = None,
+             delay = 0):
+    '''Report a run that was skipped because the last one is still going
+
+       The report goes through the same alert checks and metrics as a run
+       that finished. deliver is passed on to send_mail(). Returns the list
+       of errors'''
+    e = 'Skipped because the previous run is still going'
+    if holder is not None:
+        e += ' (pid %i)' % holder
+    errors = [e]
+    export_errors = []
+
+    # Check whether the same failure has already been reported
+    alert = (None, 0, None)
+    if config[section]['alert_window']:
+        try:
+            alert = check_alert(tag, get_alert_digest(sha1(to_bytes(tag)),
+                                                      errors),
+                                config[section]['alert_window'])
+        except Error as e:
+            export_errors.append(e)
+
+    subject += ' (skipped)'
+    if alert[0] == 'repeat':
+        subject += ' (still failing, %i times)' % alert[1]
+
+    now = time.time()
+    text = 'The following command line was not executed:\n'
+    text += '%s\n' % ' '.join(args)
+    text += '\n'
+    text += 'Skipped at: %s\n' % get_now()
+    if alert[0] == 'repeat':
+        text += 'Failed %i times since: %s\n' % (alert[1], alert[2])
+    if delay:
+        text += 'Start delayed by splay: %.1f seconds\n' % delay
+    text += '\n'
+    text += 'Errors:\n'
+    for e in errors:
+        text += '  * %s\n' % e
+
+    if config[section]['logfile']:
+        fn = datetime.now().strftime(config[section]['logfile'])
+        logfile = open(fn, 'ab')
+        offset = start_log_entry(logfile)
+        logfile.write(to_bytes(text + '\n'))
+        finish_log_entry(logfile, offset, {'tag': tag, 'start': now,
+                                           'end': now, 'exit': None,
+                                           'errors': errors})
+        logfile.close()
+
+    if config[section]['metrics_dir']:
+        metrics = {'last_run_timestamp_seconds': now,
+                   'duration_seconds': 0,
+                   'splay_seconds': delay,
+                   'exit_code': -1,
+                   'skipped': 1,
+                   'errors': len(errors),
+                   'output_bytes': 0,
+                   'output_lines': 0}
+        try:
+            write_metrics(config[section]['metrics_dir'], tag, metrics, {})
+        except Error as e:
+            export_errors.append(e)
+
+    if alert[0] != 'suppress':
+        to_addr = get_recipients(config[section]['email_to'],
+                                 config[section]['email_route'],
+                                 get_error_types(errors))
+        send_mail(config[section]['email_sendmail'], subject, text, to_addr,
+                  config[section]['email_from'], deliver = deliver)
+    elif deliver is not None:
+        deliver.retry()
+
+    if export_errors:
+        raise Error('; '.join([str(e) for e in export_errors]))
+
+    return errors
+
+def watch(args, config = None, tag = None, force_blacklist = True,
+          config_dir = None, splay = True, replay = None):
+    '''Watch a job and capture output
+
+       config can either be the name of a configuration file or a 
+       configuration that has already been read. If splay is False, the job
+       starts right away regardless of the splay setting. If replay is a
+       Replay, its output is checked instead of running the job, and nothing
+       is logged, saved or mailed. Returns the list of errors'''
     
     # Read the configuration
-    config = read_config(config)
+    if not isinstance(config, ConfigObj):
+        config = read_config(config, config_dir)
     
     # Determine the tag automatically
     if tag is None:
         tag = os.path.basename(args[0])
     
     # Determine the conf section to use
-    if not config.has_key(tag):
+    if tag not in config:
         section = '_default_'
     else:
         section = tag
 
     
     # Open the configuration file
-    if config[section]['logfile']:
-        fn = datetime.now().strftime(config[section]['logfile'])
-        logfile = open(fn, 'a')
+    logname = None
+    if config[section]['logfile'] and replay is None:
+        logname = datetime.now().strftime(config[section]['logfile'])
+        logfile = open(logname, 'ab')
+
+    blacklist_rx = config[section]['blacklist']
+    if not (config[section]['required'] or
+        config[section]['whitelist'] or
+        config[section]['blacklist'] or
+        config[section]['stderr_whitelist'] or
+        config[section]['stderr_blacklist']) and force_blacklist:
+        blacklist_rx = [re.compile('.*')]
+
+    # Create the counters for keeping track of what we've found
+    required = {}
+    for r in config[section]['required']: required[r.pattern] = 0
+    
+    blacklist = {}
+    for r in blacklist_rx: blacklist[r.pattern] = 0
+
+    whitelist = True
+    whitelist_hits = {}
+    for r in config[section]['whitelist'] or []: whitelist_hits[r.pattern] = 0
+
+    rx = {'required': config[section]['required'],
+          'whitelist': config[section]['whitelist'],
+          'blacklist': blacklist_rx}
+    hits = {'required': required, 'whitelist': whitelist_hits,
+            'blacklist': blacklist}
+
+    # Keep stats on the patterns if asked to, and always when replaying
+    pattern_stats = None
+    if replay is not None:
+        pattern_stats = replay.timings
+    elif config[section]['pattern_stats'] or config[section]['stats_file']:
+        pattern_stats = {}
+    line_no = [0]
+    if pattern_stats is not None:
+        rx = wrap_patterns(rx, pattern_stats, line_no)
+
+    # stderr can have its own lists if it's captured separately
+    separate = config[section]['capture'] == 'separate' and replay is None
+    rx_err = dict(rx)
+    hits_err = dict(hits)
+    stderr_hits = {}
+    for t in ('whitelist', 'blacklist'):
+        if config[section]['stderr_' + t] is not None:
+            rx_err[t] = config[section]['stderr_' + t]
+            if pattern_stats is not None:
+                rx_err[t] = wrap_patterns({'stderr_' + t: rx_err[t]},
+                                          pattern_stats,
+                                          line_no)['stderr_' + t]
+            hits_err[t] = stderr_hits['stderr_' + t] = {}
+            for r in rx_err[t]: hits_err[t][r.pattern] = 0
+
+    # Set up the e-mail
+    hostname = config[section]['hostname']
+    subject = 'cronwatch <%s> %s' % (get_user_hostname(hostname),
+                                     ' '.join(args))
+    to_addr = config[section]['email_to']
+    routes = config[section]['email_route']
+    from_addr = config[section]['email_from']
+    if from_addr is None and hostname is not None:
+        from_addr = get_user_hostname(hostname)
+    sendmail = config[section]['email_sendmail']
+
+    # Don't make the job wait for the mail to go out if asked not to
+    deliver = None
+    if config[section]['email_detach'] and replay is None:
+        deliver = MailDelivery(tag, logname)
+
+    # Let someone know right away if the job stalls
+    idle_timeout = config[section]['idle_timeout']
+    stall_mail = None
+    if config[section]['idle_notify']:
+        text = 'The following command line has not printed anything for ' + \
+               '%i seconds and is still running:\n' % idle_timeout
+        text += '%s\n' % ' '.join(args)
+        stall_mail = (sendmail, subject + ' (stalled)', text,
+                      get_recipients(to_addr, routes, ['error', 'stalled']),
+                      from_addr, None, None, deliver)
+    stalls = StallHandler(stall_mail)
+
+    # Spread out jobs that are all scheduled at the same time
+    delay = 0
+    if splay and replay is None:
+        delay = get_splay(tag, config[section]['splay'],
+                          config[section]['splay_mode'])
+        time.sleep(delay)
+
+    # Make sure copies of the job don't overlap and the host isn't overloaded
+    lock = None
+    if config[section]['lock'] != 'none' and replay is None:
+        lock = JobLock(tag)
+        if not lock.acquire(config[section]['lock']):
+            return skip_job(args, config, section, tag, subject,
+                            lock.holder, deliver, delay)
+
+    slots = None
+    if config['_default_']['max_concurrent'] and replay is None:
+        slots = SlotPool(config['_default_']['max_concurrent'])
+        slots.acquire()
+
+    # Set the job's priority and limits
+    resources = {}
+    if config[section]['nice']:
+        resources['nice'] = config[section]['nice']
+    if config[section]['ionice_class'] != 'none':
+        resources['ionice'] = (config[section]['ionice_class'],
+                               config[section]['ionice_priority'])
+    limits = {}
+    limit_rx = {}
+    for name in sorted(RESOURCE_LIMITS):
+        if config[section][name] > -1:
+            limits[RESOURCE_LIMITS[name]] = config[section][name]
+            if name in LIMIT_MESSAGES:
+                limit_rx[name] = LIMIT_MESSAGES[name]
+    if limits:
+        resources['limits'] = limits
+    limit_hits = set()
 
     # Run the actual program
+    max_capture = config[section]['max_capture']
+    max_line_length = config[section]['max_line_length']
+    if separate:
+        discarded = OutputCounter(rx, hits, rx_err, hits_err,
+                                  max_line_length)
+    else:
+        discarded = OutputCounter(rx, hits, max_line_length = max_line_length)
     start_time = get_now()
-    (oh, exit) = run(args)
+    start = time.time()
+    if replay is not None:
+        (oh, exit) = (replay.fh, (config[section]['exit_codes'] or [0])[0])
+    else:
+        try:
+            (oh, exit) = run(args, max_capture = max_capture,
+                             discard = discarded.feed,
+                             kill = config[section]['max_capture_kill'],
+                             spool_size = config[section]['spool_size'],
+                             separate = separate,
+                             idle_timeout = idle_timeout, on_idle = stalls,
+                             idle_kill = config[section]['idle_kill'],
+                             on_start = lock and lock.set_pid,
+                             new_session = config[section]['lock'] ==
+                                           'kill-old',
+                             resources = resources,
+                             max_line_length = max_line_length)
+        finally:
+            if slots:
+                slots.release()
+            if lock:
+                lock.release()
+    end = time.time()
     end_time = get_now()
+    discarded.close()
 
     errors = []
 
@@ -308,54 +1916,182 @@ def watch(args, config = None, tag = None, force_blacklist = True):
     if exit not in config[section]['exit_codes']:
         errors.append('Exit code (%i) is not a valid exit code' % exit)
 
-    if not (config[section]['required'] or
-        config[section]['whitelist'] or
-        config[section]['blacklist']) and force_blacklist:
-        config[section]['blacklist'] = [re.compile('.*')]
-
-    # Create the flags/vars for keeping track of what we've found
-    required = {}
-    for r in config[section]['required']: required[r.pattern] = False
-    
-    blacklist = {}
-    for r in config[section]['blacklist']: blacklist[r.pattern] = False
-
-    whitelist = True
-
-    outfile = TemporaryFile()
+    # Check if the job was killed for going over one of its limits
+    if exit == -signal.SIGXCPU and config[section]['limit_cpu'] > -1:
+        errors.append('Job exceeded limit_cpu (%i seconds)' %
+                      config[section]['limit_cpu'])
+    if exit == -signal.SIGXFSZ and config[section]['limit_fsize'] > -1:
+        errors.append('Job exceeded limit_fsize (%i bytes)' %
+                      config[section]['limit_fsize'])
+
+    # Check if the job stalled
+    if stalls.stalls:
+        e = 'No output for %i seconds (job stalled)' % idle_timeout
+        if config[section]['idle_kill']:
+            e += ' and the job was killed'
+        errors.append(e)
+    for e in stalls.errors:
+        errors.append('Could not send the stall notification (%s)' % e)
+
+    # Check if the output got too big
+    if discarded.bytes:
+        e = 'Output exceeded max_capture (%i bytes)' % max_capture
+        if config[section]['max_capture_kill']:
+            e += ' and the job was killed'
+        errors.append(e)
+
+    fingerprint = sha1(to_bytes(tag))
+
+    # Failing to export the results of the run shouldn't cost the e-mail, so
+    # these errors are only raised once it has been sent
+    export_errors = []
+
+    track_changes = (config[section]['email_changes'] or
+                     config[section]['email_diff']) and replay is None
+    output_hash = sha1()
+
+    # The text of the lines is kept for the next run to compare against
+    tracked = None
+    if track_changes:
+        tracked = spooled_file(config[section]['spool_size'])
+
+    outfile = spooled_file(config[section]['spool_size'])
+
+    # Only keep the flagged lines and the lines around them if asked to
+    context = config[section]['output_context']
+    before = deque(maxlen = max(context, 0))
+    after = 0
+    written = 0
+
+    # Long lines are split into pieces, and each piece is checked along with
+    # the end of the piece before it, so matches across the split are found
+    overlap = config[section]['line_overlap']
+    tails = {}
+
+    # The pieces of a line share its number and each pattern only counts once
+    # for the whole line
+    pieces = {}
+    seen = {}
 
     # Go through the output file and prepare a new one for mailing out
     outline = None
     lines = 0
-    for l in oh:
+    size = 0
+    if separate:
+        # run() already split the long lines
+        capture = read_lines(oh)
+    else:
+        capture = read_lines(oh, max_line_length)
+    for (raw, cut) in capture:
+        l = text = to_text(raw)
+        stream = 'O'
+        (line_rx, line_hits) = (rx, hits)
+        if separate:
+            (stream, offset, text) = parse_capture_line(l)
+            if stream.islower():
+                (stream, cut, text) = (stream.upper(), True, text[:-1])
+            if stream == 'E':
+                (line_rx, line_hits) = (rx_err, hits_err)
+
+        # Only the text after the ASCII prefix counts, in bytes
+        size += len(raw) - len(l) + len(text)
+        check = tails.get(stream, '') + text
+        if cut:
+            tails[stream] = overlap and text[-overlap:] or ''
+            text += '\n'
+        elif tails:
+            tails[stream] = ''
+
+        if separate:
+            l = '[%s +%.3fs] %s' % (STREAM_NAMES[stream], offset, text)
+        else:
+            l = text
+
         outline = '  %s' % l
-        lines += 1
-
-        # Check for required lines
-        found = line_search(l, config[section]['required'])
-        if found[0]:
-            for p in found[1]:
-                required[p] = True
-
-        # Check for whitelist lines
-        if config[section]['whitelist'] != None:
-            found = line_search(l, config[section]['whitelist'])
-            if not found[0]:
-                whitelist = False
-                outline = '* %s' % l
-
-        # Check for blacklist lines
-        found = line_search(l, config[section]['blacklist'])
-        if found[0]:
-            for p in found[1]:
-                blacklist[p] = True
-            outline = '! %s' % l
-
-        outfile.write(outline)
+        continued = pieces.get(stream, False)
+        pieces[stream] = cut
+        if not continued:
+            lines += 1
+            seen[stream] = set()
+        line_no[0] = lines
+
+        if track_changes:
+            tracked.write(to_bytes(text))
+            n = text
+            for r in config[section]['output_normalize']:
+                n = r.sub('', n)
+            output_hash.update(to_bytes(n))
+
+        for name in limit_rx:
+            if limit_rx[name].search(check):
+                limit_hits.add(name)
+
+        if cut or continued:
+            (flag, listed) = check_piece(check, line_rx, line_hits,
+                                         seen[stream], not cut)
+        else:
+            (flag, listed) = check_line(check, line_rx, line_hits)
+        if not listed:
+            whitelist = False
+        if flag != ' ':
+            outline = '%s %s' % (flag, l)
+
+        # Numbers like times and PIDs shouldn't make a failure look new
+        if outline[0] != ' ':
+            fingerprint.update(to_bytes(re.sub('[0-9]+', '#',
+                                               outline.strip()) + '\n'))
+
+        if context < 0:
+            outfile.write(to_bytes(outline))
+            continue
+
+        outline = '%s%i: %s' % (outline[:2], lines, l)
+        if outline[0] != ' ':
+            first = lines
+            if before:
+                first = before[0][0]
+            if first > written + 1:
+                outfile.write(b'  [%i lines omitted]\n' %
+                              (first - written - 1))
+            for (n, o) in before:
+                outfile.write(to_bytes(o))
+            outfile.write(to_bytes(outline))
+            before.clear()
+            after = context
+            written = lines
+        elif continued and written == lines:
+            # The rest of a line that's already shown
+            outfile.write(to_bytes(outline))
+        elif after > 0:
+            outfile.write(to_bytes(outline))
+            after -= 1
+            written = lines
+        else:
+            before.append((lines, outline))
+
+    if context > -1 and lines > written:
+        outfile.write(b'  [%i lines omitted]\n' % (lines - written))
+
+    # The counters still cover the output that wasn't saved
+    if discarded.bytes:
+        if outline is not None and outline[-1] != '\n':
+            outfile.write(b'\n')
+        outfile.write(b'  [%i more lines (%i bytes) were not saved]\n' %
+                      (discarded.lines, discarded.bytes))
+        lines += discarded.lines
+        size += discarded.bytes
+        if not discarded.listed:
+            whitelist = False
 
     outfile.flush()
     outfile.seek(0)
 
+    # The job doesn't get a signal for these limits, only failed calls
+    if exit not in config[section]['exit_codes']:
+        for name in sorted(limit_hits):
+            errors.append('Job may have run into %s (%i)' %
+                          (name, config[section][name]))
+
     # Check to make sure all the required regexes got hit
     for r in sorted(required):
         if not required[r]:
@@ -372,11 +2108,26 @@ def watch(args, config = None, tag = None, force_blacklist = True):
             errors.append('Output matched by blacklist (%s) ' % r +
                           '(denoted by "!" in output)')
 
+    for r in sorted(stderr_hits.get('stderr_blacklist', {})):
+        if stderr_hits['stderr_blacklist'][r]:
+            errors.append('stderr matched by stderr_blacklist (%s) ' % r +
+                          '(denoted by "!" in output)')
+
+    # Check whether the same failure has already been reported
+    alert = (None, 0, None)
+    if config[section]['alert_window'] and replay is None:
+        # Without the alert state every failure is mailed
+        try:
+            alert = check_alert(tag, get_alert_digest(fingerprint, errors),
+                                config[section]['alert_window'])
+        except Error as e:
+            export_errors.append(e)
+
     # Construct the e-mail/log
-    subject = 'cronwatch <%s> %s' % (get_user_hostname(), ' '.join(args))
-    to_addr = config[section]['email_to']
-    from_addr = config[section]['email_from']
-    sendmail = config[section]['email_sendmail']
+    if alert[0] == 'repeat':
+        subject += ' (still failing, %i times)' % alert[1]
+    elif alert[0] == 'recovered':
+        subject += ' (recovered)'
 
     if errors:
         text = 'The following command line executed with errors:\n'
@@ -389,10 +2140,19 @@ def watch(args, config = None, tag = None, force_blacklist = True):
     text += 'Started execution at:  %s\n' % start_time
     text += 'Finished execution at: %s\n' % end_time
     text += 'Exit code: %i\n' % exit
+    if alert[0] in ('repeat', 'recovered'):
+        text += 'Failed %i times since: %s\n' % (alert[1], alert[2])
+    if delay:
+        text += 'Start delayed by splay: %.1f seconds\n' % delay
+    if lock and lock.holder is not None:
+        text += 'Waited for the previous run (pid %i): %.1f seconds\n' % \
+                (lock.holder, lock.waited)
+    if slots and slots.waited:
+        text += 'Queued for a free slot: %.1f seconds\n' % slots.waited
     text += '\n'
 
     if config[section]['preamble_file']:
-        text += open(config[section]['preamble_file']).read()
+        text += to_text(open(config[section]['preamble_file'], 'rb').read())
         text += '\n'
 
     if errors:
@@ -401,10 +2161,61 @@ def watch(args, config = None, tag = None, force_blacklist = True):
             text += '  * %s\n' % e
         text += '\n\n'
 
+    if config[section]['pattern_stats'] and pattern_stats:
+        text += format_pattern_stats(pattern_stats)
+        text += '\n'
+
+    # Compare the output to the last run's
+    changed = True
+    diff = None
+    diff_skipped = False
+    if track_changes:
+        (old_hash, old_file) = get_previous_output(tag)
+        changed = old_hash != output_hash.hexdigest()
+
+        tracked.seek(0)
+        if config[section]['email_diff'] and old_hash is not None:
+            # difflib needs both outputs in memory, so outputs that are too
+            # big to mail are only read up to the point where that's clear
+            n = config[section]['email_maxsize']
+            if n > -1:
+                n += 1
+
+            # A missing or corrupt copy is the same as no previous output
+            try:
+                old = GzipFile(old_file).read(n)
+            except (IOError, OSError, EOFError, zlib.error):
+                (old, changed) = (None, True)
+
+            new = tracked.read(n)
+            if old is None:
+                pass
+            elif n > -1 and (len(old) == n or len(new) == n):
+                diff_skipped = True
+            else:
+                # difflib is only needed here, so it isn't loaded at startup
+                import difflib
+                diff = ''.join(difflib.unified_diff(
+                    [to_text(l) for l in BytesIO(old).readlines()],
+                    [to_text(l) for l in BytesIO(new).readlines()],
+                    'previous run', 'this run'))
+            (old, new) = (None, None)
+            tracked.seek(0)
+
+        try:
+            save_output(tag, tracked, output_hash.hexdigest())
+        except Error as e:
+            export_errors.append(e)
+        tracked.close()
+
+    if diff_skipped:
+        text += 'The output is too big to compare to the last run.\n\n'
+
+    header = text
     text += 'Output:\n'
     
     maxsize = config[section]['email_maxsize']
-    output = outfile.read(maxsize)
+    output = to_text(outfile.read(maxsize))
 
     if len(output) == 0:
         empty = True
@@ -414,18 +2225,59 @@ def watch(args, config = None, tag = None, force_blacklist = True):
     text += output
 
     # Start the log file
-    if config[section]['logfile']:
-        logfile.write(text)
+    if config[section]['logfile'] and replay is None:
+        offset = start_log_entry(logfile)
+        logfile.write(to_bytes(text))
     
         if empty:
-            logfile.write('  No output\n\n')
+            logfile.write(b'  No output\n\n')
         else:
+            last = output[-1:]
             for l in outfile:
                 logfile.write(l)
-
-            if l[-1] != '\n':
-                logfile.write('\n')
-            logfile.write('[EOF]\n\n')
+                last = to_text(l[-1:])
+
+            if last != '\n':
+                logfile.write(b'\n')
+            logfile.write(b'[EOF]\n\n')
+
+        finish_log_entry(logfile, offset, {'tag': tag, 'start': start,
+                                           'end': end, 'exit': exit,
+                                           'errors': errors})
+
+    # Attach the whole output to the e-mail
+    attachment = None
+    if config[section]['email_attach'] and not empty:
+        outfile.seek(0)
+        (data, truncated) = compress_output(outfile,
+                                    config[section]['email_attach_maxsize'],
+                                    config[section]['spool_size'])
+        attachment = ('output.txt.gz', data)
+        if truncated:
+            header += 'The attached output was truncated at %i bytes.\n\n' \
+                      % config[section]['email_attach_maxsize']
+
+    # Only the changes go in the e-mail
+    if diff is not None:
+        text = header + 'Output changes since the last run:\n'
+        output = diff
+        if len(output) == 0:
+            output = '  No changes\n'
+        text += output
+
+    # Only the flagged lines go in the e-mail
+    elif attachment is not None:
+        text = header + 'Flagged output (the full output is attached):\n'
+        outfile.seek(0)
+        output = ''
+        for l in outfile:
+            if maxsize > -1 and len(output) > maxsize:
+                break
+            if not l.startswith(b' '):
+                output += to_text(l)
+        if len(output) == 0:
+            output = '  No flagged output\n'
+        text += output
         
     if maxsize > -1 and len(text) > config[section]['email_maxsize']:
         text = text [:config[section]['email_maxsize']]
@@ -438,12 +2290,646 @@ def watch(args, config = None, tag = None, force_blacklist = True):
         else:
             text += '  No output'
 
-    if errors or config[section]['email_success']:
-        send_mail(sendmail, subject, text, to_addr, from_addr)
+    if config[section]['metrics_dir'] and replay is None:
+        metrics = {'last_run_timestamp_seconds': end,
+                   'duration_seconds': end - start,
+                   'splay_seconds': delay,
+                   'exit_code': exit,
+                   'skipped': 0,
+                   'errors': len(errors),
+                   'output_bytes': size,
+                   'output_lines': lines}
+        metric_hits = dict(hits)
+        metric_hits.update(stderr_hits)
+        try:
+            write_metrics(config[section]['metrics_dir'], tag, metrics,
+                          metric_hits)
+        except Error as e:
+            export_errors.append(e)
+
+    if config[section]['stats_file'] and replay is None:
+        try:
+            write_pattern_stats(config[section]['stats_file'], tag, end,
+                                lines, pattern_stats)
+        except Error as e:
+            export_errors.append(e)
+
+    if replay is not None:
+        replay.lines += lines
+        if replay.report is not None:
+            write_bytes(replay.report,
+                        to_bytes('Subject: %s\n\n%s\n' % (subject, text)))
+    elif alert[0] != 'suppress' and (errors or
+         (config[section]['email_success'] and
+          (changed or not config[section]['email_changes'])) or
+         (alert[0] == 'recovered' and config[section]['alert_recovery'])):
+        send_mail(sendmail, subject, text,
+                  get_recipients(to_addr, routes, get_error_types(errors)),
+                  from_addr, attachment = attachment, deliver = deliver)
+    elif deliver is not None:
+        # Without a message of its own the run still retries the queue
+        deliver.retry()
+
+    if export_errors:
+        raise Error('; '.join([str(e) for e in export_errors]))
+
+    return errors
+
+###############################################################################
+# Daemon functions
+###############################################################################
+def get_socket(socket_path = None):
+    '''Return the name of the daemon's socket'''
+    if socket_path is None:
+        socket_path = os.environ.get('CRONWATCH_SOCKET')
+    if not socket_path:
+        socket_path = os.path.join(STATEDIR, 'cronwatchd.sock')
+    return socket_path
+
+def recv_all(conn):
+    '''Read from a socket until the other end stops sending'''
+    data = []
+    while True:
+        d = conn.recv(65536)
+        if not d:
+            break
+        data.append(d)
+    return to_text(b''.join(data))
+
+def get_config_stamp(config_file = None, config_dir = None):
+    '''Return a value that changes when the configuration files change'''
+    if config_file is None:
+        config_file = CONFIGFILE
+        if config_dir is None and os.path.isdir(CONFIGDIR):
+            config_dir = CONFIGDIR
+
+    files = [config_file]
+    if config_dir is not None and os.path.isdir(config_dir):
+        files += [os.path.join(config_dir, f) 
+                  for f in sorted(os.listdir(config_dir))]
+
+    stamp = []
+    for f in files:
+        try:
+            st = os.stat(f)
+            stamp.append((f, st.st_mtime, st.st_size))
+        except OSError:
+            stamp.append((f, None, None))
+    return stamp
+
+def call_daemon(socket_path, args, config = None, tag = None, 
+                config_dir = None, splay = True):
+    '''Hand a job over to cronwatchd and wait for it to finish
+
+       Returns False if the daemon isn't running'''
+
+    request = json.dumps({'args': args, 'tag': tag, 'config': config,
+                          'config_dir': config_dir, 'cwd': os.getcwd(),
+                          'env': dict(os.environ), 'splay': splay})
+
+    # The daemon only runs a job once it has read all of the request, so
+    # until then it's safe to fall back
+    conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    conn.settimeout(DAEMON_TIMEOUT)
+    try:
+        conn.connect(socket_path)
+        conn.sendall(to_bytes(request))
+        conn.shutdown(socket.SHUT_WR)
+    except socket.error:
+        conn.close()
+        return False
+
+    # The reply only comes once the job is done
+    try:
+        conn.settimeout(None)
+        reply = recv_all(conn)
+        conn.close()
+        reply = json.loads(reply)
+    except Exception as e:
+        raise Error('lost connection to cronwatchd: %s' % e)
+
+    if reply['error']:
+        raise Error(reply['error'])
+
+    return True
+
+def handle_request(conn, configs):
+    '''Read a job from a client and run it in a child process of the daemon
+
+       configs holds the configurations the daemon has already read, keyed
+       by the configuration file and directory.'''
+
+    error = None
+    try:
+        # Only accept jobs from the user running the daemon
+        cred = conn.getsockopt(socket.SOL_SOCKET, SO_PEERCRED,
+                               struct.calcsize('3i'))
+        if struct.unpack('3i', cred)[1] != os.getuid():
+            raise Error('permission denied')
+
+        # A client that stops sending only holds up its own child
+        conn.settimeout(DAEMON_TIMEOUT)
+        try:
+            request = json.loads(recv_all(conn))
+        except socket.timeout:
+            raise Error('timed out reading the request')
+        conn.settimeout(None)
+
+        key = (request['config'], request['config_dir'])
+        if key in configs and configs[key][0] == get_config_stamp(*key):
+            config = configs[key][1]
+        else:
+            config = read_config(*key)
+
+        os.chdir(request['cwd'])
+        os.environ.clear()
+        args = request['args']
+        if PY3:
+            os.environ.update(request['env'])
+        else:
+            for (k, v) in request['env'].items():
+                os.environ[k.encode('utf-8')] = v.encode('utf-8')
+            args = [a.encode('utf-8') for a in args]
+        watch(args, config = config, tag = request['tag'],
+              splay = request.get('splay', True))
+    except Exception as e:
+        error = str(e)
+
+    try:
+        conn.sendall(to_bytes(json.dumps({'error': error})))
+    except socket.error:
+        pass
+    conn.close()
+
+def serve(socket_path):
+    '''Run cronwatchd
+
+       Each connection is handed to a forked child, which reads the job and
+       runs it. The default configuration is read here before the fork, so
+       it's shared instead of read for each job.'''
+
+    configs = {}
+
+    if os.path.exists(socket_path):
+        os.unlink(socket_path)
+
+    d = os.path.dirname(socket_path)
+    if d and not os.path.isdir(d):
+        os.makedirs(d)
+
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    old_umask = os.umask(0o077)
+    try:
+        server.bind(socket_path)
+    finally:
+        os.umask(old_umask)
+    server.listen(128)
+
+    # Let the children reap themselves and clean up the socket on SIGTERM
+    signal.signal(signal.SIGCHLD, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+    try:
+        while True:
+            try:
+                (conn, addr) = server.accept()
+            except socket.error as e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise
+
+            # Keep the default configuration up to date for the children.
+            # If it's broken, the child reads it again and reports the error.
+            key = (None, None)
+            stamp = get_config_stamp(*key)
+            if key not in configs or configs[key][0] != stamp:
+                try:
+                    configs[key] = (stamp, read_config(*key))
+                except Error:
+                    configs.pop(key, None)
+
+            if os.fork() == 0:
+                signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+                signal.signal(signal.SIGTERM, signal.SIG_DFL)
+                server.close()
+                handle_request(conn, configs)
+                os._exit(0)
+
+            conn.close()
+    finally:
+        server.close()
+        os.unlink(socket_path)
+
+###############################################################################
+# Profiling functions
+###############################################################################
+def is_child_wait(func):
+    '''Tell if a profiled function is spent waiting for the job'''
+    return func[0] == '~' and func[2] in CHILD_WAIT_FUNCTIONS
+
+def get_start_wait(func, callers):
+    '''Return how much of a profiled function's own time was spent holding
+       the job back'''
+    if func[0] != '~' or func[2] not in START_WAIT_FUNCTIONS:
+        return 0.0
+    waited = 0.0
+    for (caller, (cc, nc, tt, ct)) in callers.items():
+        if caller[0] == main.__code__.co_filename and \
+           caller[2] in START_WAIT_CALLERS:
+            waited += tt
+    return waited
+
+def get_function_name(func):
+    '''Format a profiled function's name'''
+    if func[0] == '~':
+        return func[2]
+    return '%s:%i(%s)' % (os.path.basename(func[0]), func[1], func[2])
+
+def print_profile_table(title, stats, funcs, own = None):
+    '''Print the stats for a list of profiled functions
+
+       own can replace the functions' own times.'''
+    print(title)
+    print('  %10s %10s %10s  %s' % ('own', 'cumulative', 'calls', 'function'))
+    for func in funcs:
+        (cc, nc, tt, ct, callers) = stats[func]
+        if own is not None:
+            tt = own[func]
+        print('  %10.4f %10.4f %10i  %s' % (tt, ct, nc,
+                                            get_function_name(func)))
+    print()
+
+def profile_report(profile_file, limit = 15):
+    '''Summarize a profile written with --profile'''
+
+    import pstats
+    try:
+        stats = pstats.Stats(profile_file).stats
+    except Exception as e:
+        raise Error('could not read profile %s: %s' % (profile_file, e))
+
+    total = 0.0
+    child = 0.0
+    start = 0.0
+    own = {}
+    for (func, (cc, nc, tt, ct, callers)) in stats.items():
+        total += tt
+        if is_child_wait(func):
+            child += tt
+        else:
+            waited = get_start_wait(func, callers)
+            start += waited
+            own[func] = tt - waited
+
+    print('Total time:           %.4fs' % total)
+    print('Waiting for the job:  %.4fs' % child)
+    print('Waiting to start:     %.4fs' % start)
+    print('cronwatch overhead:   %.4fs' % (total - child - start))
+    print()
+
+    # The waits for splay, the lock and a slot aren't overhead either
+    funcs = list(own)
+    funcs.sort(key = lambda f: own[f], reverse = True)
+    print_profile_table('Hottest functions (by own time, excluding the job):',
+                        stats, funcs[:limit], own)
+
+    funcs = [f for f in stats if f[0] == main.__code__.co_filename]
+    funcs.sort(key = lambda f: stats[f][3], reverse = True)
+    print_profile_table('cronwatch functions (by cumulative time):',
+                        stats, funcs[:limit])
+
+###############################################################################
+# Replay functions
+###############################################################################
+class Replay(object):
+    '''Output of an earlier run for watch() to check instead of running a job
+
+       The report is written to report unless it's None. timings holds the
+       pattern stats, as kept by wrap_patterns(), and can be shared between
+       replays to add them up.'''
+    def __init__(self, fh, report = None, timings = None):
+        self.fh = fh
+        self.report = report
+        if timings is None:
+            timings = {}
+        self.timings = timings
+        self.lines = 0
+
+def open_replay_file(fn):
+    '''Open a file of saved output, which may be compressed'''
+    try:
+        if fn.endswith('.gz'):
+            return GzipFile(fn, 'rb')
+        return open(fn, 'rb')
+    except IOError as e:
+        raise Error('could not open %s: %s' % (fn, e))
+
+def print_timings(timings, lines, elapsed):
+    '''Print how long each pattern took and the overall throughput'''
+    print('Pattern timings:')
+    print('  %-10s %10s %10s %10s  %s' % ('list', 'searches', 'total (s)',
+                                           'per 1k (s)', 'pattern'))
+    keys = sorted(timings, key = lambda k: timings[k][1], reverse = True)
+    for (name, pattern) in keys:
+        (n, t) = timings[(name, pattern)][:2]
+        print('  %-10s %10i %10.4f %10.4f  %s' % (name, n, t,
+                                                  t * 1000 / max(n, 1),
+                                                  pattern))
+    print()
+    print('Replayed %i lines in %.3fs (%.0f lines/s)' %
+          (lines, elapsed, lines / max(elapsed, 0.000001)))
+
+def replay_output(path, tag, config = None, config_dir = None):
+    '''Check saved output against a tag's configuration
+
+       path is a file, "-" for stdin, or a directory of files. A single
+       file's report is printed in full, while a directory only gets a line
+       for each file. Returns the number of replays that found errors.'''
+
+    if not isinstance(config, ConfigObj):
+        config = read_config(config, config_dir)
+
+    timings = {}
+    lines = 0
+    failed = 0
+    start = time.time()
+
+    if os.path.isdir(path):
+        for fn in sorted(os.listdir(path)):
+            fn = os.path.join(path, fn)
+            if not os.path.isfile(fn):
+                continue
+            replay = Replay(open_replay_file(fn), timings = timings)
+            errors = watch([fn], config = config, tag = tag, replay = replay)
+            lines += replay.lines
+            if errors:
+                failed += 1
+                print('%s: %s' % (fn, '; '.join(errors)))
+            else:
+                print('%s: OK' % fn)
+    else:
+        name = path
+        if path == '-':
+            (fh, name) = (getattr(sys.stdin, 'buffer', sys.stdin), '<stdin>')
+        else:
+            fh = open_replay_file(path)
+        replay = Replay(fh, sys.stdout, timings)
+        if watch([name], config = config, tag = tag, replay = replay):
+            failed += 1
+        lines += replay.lines
+
+    print()
+    print_timings(timings, lines, time.time() - start)
+    return failed
+
+###############################################################################
+# Config checking functions
+###############################################################################
+def get_probe_lines(rx, n):
+    '''Return lines of length n that are likely to be slow for a pattern
+
+       Backtracking blows up on long runs of characters that almost match,
+       so the lines repeat the pattern's own literal characters and end in
+       something that doesn't match.'''
+    literal = re.sub(r'\\.|[^A-Za-z0-9 _:;,=/-]', '', rx.pattern) or 'a'
+    lines = []
+    for chars in ('a', ' ', literal, SAMPLE_LINE):
+        line = (chars * (n // len(chars) + 1))[:n]
+        lines.append(line)
+        lines.append(line + '\x00')
+    return lines
+
+def measure_pattern(rx, budget, out):
+    '''Time a pattern against longer and longer probe lines
+
+       The searches per second on a sample log line and then the seconds per
+       search for each length are written to out as they're measured, one
+       JSON list per line. Stops once a search takes more than a tenth of the
+       budget.'''
+    reps = 1000
+    start = time.time()
+    for i in range(reps):
+        rx.search(SAMPLE_LINE)
+    out.write(json.dumps(['throughput',
+                          reps / max(time.time() - start, 0.000001)]) + '\n')
+    out.flush()
+
+    for n in PROBE_LENGTHS:
+        worst = 0
+        for line in get_probe_lines(rx, n):
+            reps = max(1, 65536 // n)
+            start = time.time()
+            for i in range(reps):
+                rx.search(line)
+            worst = max(worst, (time.time() - start) / reps)
+            if worst > budget / 10:
+                break
+        out.write(json.dumps(['time', n, worst]) + '\n')
+        out.flush()
+        if worst > budget / 10:
+            break
+
+def time_pattern(rx, budget = 2.0):
+    '''Measure a pattern in a child process that's killed if it runs too long
+
+       A regular expression can't be interrupted once it starts searching, so
+       this is the only safe way to find out. Returns a dictionary with the
+       searches per second on a sample line, a list of (length, seconds per
+       search) tuples and whether it timed out.'''
+    (r, w) = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        try:
+            os.close(r)
+            measure_pattern(rx, budget, os.fdopen(w, 'w'))
+        finally:
+            os._exit(0)
+
+    os.close(w)
+    data = b''
+    deadline = time.time() + budget
+    timeout = False
+    try:
+        while True:
+            wait = deadline - time.time()
+            if wait <= 0:
+                timeout = True
+                break
+            try:
+                ready = select.select([r], [], [], wait)[0]
+            except select.error as e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise
+            if not ready:
+                continue
+            d = os.read(r, 65536)
+            if not d:
+                break
+            data += d
+    finally:
+        os.close(r)
+        if timeout:
+            os.kill(pid, signal.SIGKILL)
+        os.waitpid(pid, 0)
+
+    # Whatever was measured before the timeout still counts
+    result = {'throughput': None, 'times': [], 'timeout': timeout}
+    for l in to_text(data).splitlines(True):
+        if not l.endswith('\n'):
+            break
+        l = json.loads(l)
+        if l[0] == 'throughput':
+            result['throughput'] = l[1]
+        else:
+            result['times'].append((l[1], l[2]))
+    return result
+
+def get_growth(times):
+    '''Estimate how a pattern's cost grows with the line length
+
+       Returns the exponent for the two longest lines, so 1 is linear and 2 is
+       quadratic, or None if there aren't enough measurements.'''
+    if len(times) < 2:
+        return None
+    ((n1, t1), (n2, t2)) = times[-2:]
+    if t1 <= 0 or t2 <= 0:
+        return None
+    return math.log(t2 / t1) / math.log(float(n2) / n1)
+
+def check_config(config_file = None, config_dir = None, budget = 2.0):
+    '''Time every pattern in the configuration and print a report
+
+       Returns the number of patterns that timed out or grew faster than
+       linearly with the line length.'''
+
+    config = read_config(config_file, config_dir)
+
+    # The same pattern is often in many sections, so only time it once
+    patterns = {}
+    for section in config.keys():
+        for name in PATTERN_SETTINGS:
+            for rx in config[section][name] or []:
+                if rx.pattern not in patterns:
+                    patterns[rx.pattern] = (rx, [])
+                where = '%s.%s' % (section, name)
+                if where not in patterns[rx.pattern][1]:
+                    patterns[rx.pattern][1].append(where)
+
+    flagged = 0
+    print('%-8s %12s %8s  %s' % ('status', 'searches/s', 'growth', 'pattern'))
+    for pattern in sorted(patterns):
+        (rx, where) = patterns[pattern]
+        result = time_pattern(rx, budget)
+        growth = get_growth(result['times'])
+
+        if growth is not None and growth > MAX_GROWTH:
+            status = 'SLOW'
+        elif result['timeout']:
+            status = 'TIMEOUT'
+        else:
+            status = 'OK'
+        if status != 'OK':
+            flagged += 1
+
+        throughput = '-'
+        if result['throughput'] is not None:
+            throughput = '%.0f' % result['throughput']
+        g = '-'
+        if growth is not None:
+            g = '%.2f' % growth
+        print('%-8s %12s %8s  %s' % (status, throughput, g, pattern))
+        print('%32s(%s)' % ('', ', '.join(where)))
+
+    print()
+    print('%i of %i patterns flagged' % (flagged, len(patterns)))
+    return flagged
+
+###############################################################################
+# Search functions
+###############################################################################
+def parse_date(date):
+    '''Turn a date from the command line into seconds since the epoch'''
+    for f in ('%Y-%m-%d %H:%M:%S', '%Y-%m-%d %H:%M', '%Y-%m-%d'):
+        try:
+            return time.mktime(datetime.strptime(date, f).timetuple())
+        except ValueError:
+            pass
+    raise Error('invalid date: %s' % date)
+
+def get_log_files(config):
+    '''Return the log files that have an index, for all the sections'''
+    files = set()
+    for section in config.keys():
+        pattern = config[section]['logfile']
+        if not pattern:
+            continue
+        # Every strftime() directive could be anything in the file name
+        pattern = re.sub('%.', '*', pattern)
+        for idx in glob.glob(get_index_file(pattern)):
+            files.add(idx[:-len('.idx')])
+    return sorted(files)
+
+def search_logs(config = None, config_dir = None, tag = None, since = None,
+                until = None, match = None, failed = False):
+    '''Print the log entries of the runs that match the query
+
+       Only the indexes are read, and the matching entries are read straight
+       from their place in the log files. since and until are seconds since
+       the epoch and match is a regular expression for the errors. Returns
+       the number of entries found.'''
+
+    if not isinstance(config, ConfigObj):
+        config = read_config(config, config_dir)
+    if match is not None:
+        match = re.compile(match)
+
+    found = 0
+    for fn in get_log_files(config):
+        log = None
+        for l in open(get_index_file(fn)):
+            try:
+                entry = json.loads(l)
+            except ValueError:
+                continue
+
+            if tag is not None and entry['tag'] != tag:
+                continue
+            if since is not None and entry['end'] < since:
+                continue
+            if until is not None and entry['start'] > until:
+                continue
+            if failed and not entry['errors']:
+                continue
+            if match is not None and not [e for e in entry['errors']
+                                          if match.search(e)]:
+                continue
+
+            if log is None:
+                log = open(fn, 'rb')
+            log.seek(entry['offset'])
+            print('==> %s:%i <==' % (fn, entry['offset']))
+            write_bytes(sys.stdout, log.read(entry['length']))
+            found += 1
+
+    return found
 
 ##############################################################################
 # Main function
 ###############################################################################
+def start_job(args, options, socket_path):
+    '''Run the job through the daemon or in this process'''
+
+    # Fall back to running the job here if the daemon isn't available
+    if os.path.exists(socket_path):
+        if call_daemon(socket_path, args, config = options.config,
+                       tag = options.tag, config_dir = options.config_dir,
+                       splay = options.splay):
+            return
+
+    watch(args, config = options.config, tag = options.tag,
+          config_dir = options.config_dir, splay = options.splay)
+
 def main(argv):
     '''Main function to handle all the command line stuff
 
@@ -455,11 +2941,75 @@ def main(argv):
     usage = 'usage: %prog [options] executable'
     parser = OptionParser(usage = usage)
     parser.add_option('-c', '--config', help = 'use CONFIG as the config file')
+    parser.add_option('-d', '--config-dir',
+                      help = 'read additional sections from DIR/*.conf',
+                      metavar = 'DIR')
     parser.add_option('-t', '--tag',
                       help = 'override the default tag with TAG')
+    parser.add_option('-s', '--socket',
+                      help = 'use the cronwatchd listening on SOCKET')
+    parser.add_option('--daemon', action = 'store_true', default = False,
+                      help = 'run as cronwatchd')
+    parser.add_option('--no-splay', action = 'store_false', dest = 'splay',
+                      default = True,
+                      help = 'start the job right away, ignoring splay')
+    parser.add_option('--profile', metavar = 'FILE',
+                      help = 'profile cronwatch and write the stats to FILE')
+    parser.add_option('--profile-report', metavar = 'FILE',
+                      help = 'summarize the profile in FILE and exit')
+    parser.add_option('--check-config', action = 'store_true',
+                      default = False,
+                      help = 'time the patterns in the configuration and exit')
+    parser.add_option('--budget', type = 'float', default = 2.0,
+                      help = 'seconds --check-config may spend on each ' +
+                             'pattern (default: 2.0)')
+    parser.add_option('--search', action = 'store_true', default = False,
+                      help = 'print the logged runs that match the query ' +
+                             '(-t, --since, --until, --match and --failed)')
+    parser.add_option('--since', metavar = 'DATE',
+                      help = 'only find runs that ended after DATE')
+    parser.add_option('--until', metavar = 'DATE',
+                      help = 'only find runs that started before DATE')
+    parser.add_option('--match', metavar = 'REGEX',
+                      help = 'only find runs with an error matching REGEX')
+    parser.add_option('--failed', action = 'store_true', default = False,
+                      help = 'only find runs with errors')
+    parser.add_option('--replay', metavar = 'FILE',
+                      help = 'check the saved output in FILE (a file, - for ' +
+                             'stdin or a directory) instead of running a job')
 
     (options, args) = parser.parse_args(args = argv)
 
+    if options.profile_report:
+        profile_report(options.profile_report)
+        return
+
+    if options.check_config:
+        return int(check_config(options.config, options.config_dir,
+                                options.budget) > 0)
+
+    if options.search:
+        since = until = None
+        if options.since:
+            since = parse_date(options.since)
+        if options.until:
+            until = parse_date(options.until)
+        return int(search_logs(options.config, options.config_dir,
+                               options.tag, since, until, options.match,
+                               options.failed) == 0)
+
+    if options.replay:
+        if not options.tag:
+            raise Error('--replay needs a tag (-t)')
+        return int(replay_output(options.replay, options.tag, options.config,
+                                 options.config_dir) > 0)
+
+    socket_path = get_socket(options.socket)
+
+    if options.daemon or os.path.basename(args[0]) == 'cronwatchd':
+        serve(socket_path)
+        return
+
     # Should specify at least one command line argument
     if len(args) == 1:
         raise Error('missing command line argument: executable')
@@ -467,16 +3017,26 @@ def main(argv):
     # Remove $0
     args.pop(0)
 
-    watch(args, config = options.config, tag = options.tag)
+    profile = options.profile or os.environ.get('CRONWATCH_PROFILE')
+    if not profile:
+        start_job(args, options, socket_path)
+        return
+
+    import cProfile
+    profiler = cProfile.Profile()
+    try:
+        profiler.runcall(start_job, args, options, socket_path)
+    finally:
+        profiler.dump_stats(profile)
 
 ###############################################################################
 # Python main calling code
 ###############################################################################
 if __name__ == '__main__':
     try:
-        main(sys.argv)
+        sys.exit(main(sys.argv))
     
-    except Exception, e:
+    except Exception as e:
         sys.stderr.write('ERROR: ' + str(e) + '\n')
         sys.exit(1)
 
@@ -1,3 +1,5 @@
+import sys
+
 from paver.easy import *
 from paver.setuputils import setup, install_distutils_tasks
 
@@ -22,11 +24,13 @@ setup(
                     'License :: OSI Approved :: GNU General Public License ' +
                         '(GPL)',
                     'Operating System :: POSIX',
+                    'Programming Language :: Python :: 2',
+                    'Programming Language :: Python :: 3',
                     'Topic :: System :: Logging',
                     'Topic :: System :: Systems Administration',
                   ],
     platforms = ['Any'],
-    scripts = ['scripts/cronwatch'],
+    scripts = ['scripts/cronwatch', 'scripts/cronwatchd'],
     test_suite = 'nose.collector',
     install_requires=['configobj'],
     zip_safe=False,
@@ -47,6 +51,7 @@ def build_scripts():
     p.rmtree()
     p.mkdir()
     path('cronwatch.py').copy(path('scripts') / 'cronwatch')
+    path('cronwatch.py').copy(path('scripts') / 'cronwatchd')
     call_task('distutils.command.build_scripts')
 
 @task
@@ -58,6 +63,12 @@ def html():
     destdir.rmtree()
     builtdocs.move(destdir)
 
+@task
+@consume_args
+def bench(args):
+    '''Measure cronwatch's overhead and compare it to the stored baseline'''
+    sh(' '.join([sys.executable, 'benchmark.py'] + args))
+
 @task
 @needs('generate_setup', 'minilib', 'html', 'build_scripts',
        'setuptools.command.sdist')
@@ -21,10 +21,15 @@
 
 import unittest
 import sys
-from StringIO import StringIO
+import os
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
 from getpass import getuser
 from socket import getfqdn, gethostname
 from shutil import rmtree
+from tempfile import mkdtemp
 
 
 __all__ = ['TestBase', 'get_user_hostname']
@@ -49,6 +54,7 @@ class TestBase(unittest.TestCase):
         unittest.TestCase.__init__(self, *args, **kwargs)
         self._capture = False
         self.__cleanup = []
+        self.__restore = []
 
     def tearDownWrapper(self):
         self.cleanup()
@@ -67,10 +73,28 @@ class TestBase(unittest.TestCase):
             self.tearDown = self.tearDownWrapper
 
     def cleanup(self):
+        for (module, name, value) in reversed(self.__restore):
+            setattr(module, name, value)
+        self.__restore = []
         for path in self.__cleanup:
             rmtree(path)
         self.__cleanup = []
 
+    def temp_statedir(self, module, name = None):
+        '''Point module.STATEDIR at a new temporary directory for the test
+
+           If name is given, STATEDIR is a directory by that name in the
+           temporary directory that doesn't exist yet. The old value is put
+           back when the test is done. Returns the temporary directory.'''
+        tempdir = mkdtemp()
+        self.register_cleanup(tempdir)
+        self.__restore.append((module, 'STATEDIR', module.STATEDIR))
+        if name is None:
+            module.STATEDIR = tempdir
+        else:
+            module.STATEDIR = os.path.join(tempdir, name)
+        return tempdir
+
     def assertRaisesError(self, exception, message, func, *args, **kwargs):
         '''Similar to assertRaises, but allows a check of the message
            variable of the exception.'''
@@ -79,7 +103,7 @@ class TestBase(unittest.TestCase):
 
         try:
             func(*args, **kwargs)
-        except exception, e:
+        except exception as e:
             self.assertEqual(str(e), message)
     
     def assertRaisesErrorMulti(self, exception, message, delimiter,
@@ -90,7 +114,7 @@ class TestBase(unittest.TestCase):
 
         try:
             func(*args, **kwargs)
-        except exception, e:
+        except exception as e:
             self.assertEqual(str(e).split(delimiter)[0], message)
 
     def start_capture(self):
@@ -58,6 +58,19 @@ case "$CMD" in
         cat > "$OUT"
         exit 0
         ;;
+    slowmail)
+        sleep 1
+        cat > "$OUT.tmp"
+        mv "$OUT.tmp" "$OUT"
+        ;;
+    mta)
+        # A sendmail that fails while the mail server is down
+        if [ ! -e "$OUT.up" ] ; then
+            echo 'mail server is down'
+            exit 75
+        fi
+        cat >> "$OUT"
+        ;;
     quiet)
         echo "quiet $*" > "$OUT"
         exit 0
@@ -65,6 +78,45 @@ case "$CMD" in
     exit)
         exit $1
         ;;
+    streams)
+        echo out1
+        sleep 0.2
+        echo err1 1>&2
+        sleep 0.2
+        echo out2
+        printf err2 1>&2
+        ;;
+    stall)
+        echo before
+        sleep 2
+        echo after
+        ;;
+    spin)
+        while true ; do
+            :
+        done
+        ;;
+    fill)
+        exec head -c 100 /dev/zero > "$OUT"
+        ;;
+    limits)
+        nice
+        ionice
+        ulimit -n
+        ;;
+    flood)
+        while true ; do
+            echo flood
+        done
+        ;;
+    partial)
+        printf abc
+        sleep 0.2
+        echo def
+        ;;
+    count)
+        seq "$1"
+        ;;
     out)
         while [ -n "$1" ] ; do
             echo $1